@@ -0,0 +1,64 @@
+'''
+Helpers of the benchmark scripts. The scripts configure Django themselves,
+so they run without a project, e.g.
+
+    python benchmarks/startup.py --help
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# lookups registered on every field
+LOOKUPS = ('iexact', 'istartswith', 'endswith', 'icontains')
+
+def configure(**options):
+    '''Configures Django with a dbindexer database wrapping an in-memory
+    SQLite database. options override the default settings.'''
+    from django.conf import settings
+    import django
+
+    values = {
+        'INSTALLED_APPS': ('djangotoolbox', 'dbindexer'),
+        'DATABASES': {
+            'default': {'ENGINE': 'dbindexer', 'TARGET': 'nonrel'},
+            'nonrel': {'ENGINE': 'django.db.backends.sqlite3',
+                       'NAME': ':memory:'},
+        },
+    }
+    values.update(options)
+    settings.configure(**values)
+    if hasattr(django, 'setup'):
+        django.setup()
+
+def create_models(prefix, count, fields):
+    '''Returns count new models with fields CharFields named field0, ...'''
+    from django.db import models
+
+    created = []
+    for number in range(count):
+        attrs = {
+            '__module__': __name__,
+            'Meta': type('Meta', (), {'app_label': 'dbindexer'}),
+        }
+        for field in range(fields):
+            attrs['field%d' % field] = models.CharField(max_length=100)
+        created.append(type('%s%d' % (prefix, number), (models.Model, ),
+                            attrs))
+    return created
+
+def field_names(fields):
+    return ['field%d' % field for field in range(fields)]
+
+def run_script(path, *args):
+    '''Runs the script at path in a new process and returns its output,
+    so each measurement starts without registered indexes.'''
+    import subprocess
+
+    process = subprocess.Popen([sys.executable, path] + list(args),
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise SystemExit('%s %s failed.' % (path, ' '.join(args)))
+    return output
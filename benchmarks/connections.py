@@ -0,0 +1,55 @@
+'''
+Measures creating dbindexer connections and looking up their compilers with
+the shared classes and settings of dbindexer.base and with the caches
+cleared before each connection, like when every connection created its own
+classes, e.g.
+
+    python benchmarks/connections.py --connections 1000
+'''
+
+from optparse import OptionParser
+import common
+import time
+
+COMPILERS = ('SQLCompiler', 'SQLInsertCompiler', 'SQLUpdateCompiler',
+             'SQLDeleteCompiler')
+
+def clear_caches():
+    from dbindexer import base
+    for cache in (base._wrapper_classes, base._operations_classes,
+                  base._compiler_classes, base._merged_settings):
+        cache.clear()
+
+def measure(count, cached):
+    '''Returns the seconds it takes to create count connections and look up
+    their compilers.'''
+    from django.conf import settings
+    from dbindexer.base import DatabaseWrapper
+
+    settings_dict = settings.DATABASES['default']
+    started = time.time()
+    for _ in range(count):
+        if not cached:
+            clear_caches()
+        connection = DatabaseWrapper(settings_dict, 'default')
+        for name in COMPILERS:
+            connection.ops.compiler(name)
+    return time.time() - started
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--connections', type='int', default=1000,
+                      help='Number of connections to create.')
+    options, args = parser.parse_args()
+
+    common.configure()
+    # the first connection imports the backend modules
+    measure(1, True)
+    for cached in (False, True):
+        seconds = measure(options.connections, cached)
+        print '%-9s %8.3f ms per connection' % (
+            cached and 'cached' or 'uncached',
+            seconds * 1000 / options.connections)
+
+if __name__ == '__main__':
+    main()
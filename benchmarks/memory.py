@@ -0,0 +1,74 @@
+'''
+Measures the memory used per registered lookup, including its index field,
+e.g.
+
+    python benchmarks/memory.py --models 300 --fields 5
+
+The resident set size is read from /proc if available and from the peak
+resident set size otherwise.
+'''
+
+from optparse import OptionParser
+import common
+import gc
+import os
+import resource
+import sys
+
+def resident_size():
+    '''Returns the resident set size of the process in bytes.'''
+    try:
+        statm = open('/proc/self/statm')
+        try:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            statm.close()
+    except (IOError, OSError, ValueError):
+        size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on Mac OS
+        if sys.platform != 'darwin':
+            size *= 1024
+        return size
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--models', type='int', default=100,
+                      help='Number of models.')
+    parser.add_option('--fields', type='int', default=5,
+                      help='Indexed fields per model.')
+    options, args = parser.parse_args()
+
+    common.configure()
+    from dbindexer.api import register_index
+    from dbindexer.manifest import get_backends
+
+    models = common.create_models('Memory', options.models, options.fields)
+    names = common.field_names(options.fields)
+    gc.collect()
+    before = resident_size()
+    for model in models:
+        register_index(model, dict([(name, common.LOOKUPS)
+                                    for name in names]))
+    gc.collect()
+    after = resident_size()
+
+    lookups = []
+    for backend in get_backends():
+        lookups.extend(backend.registry.lookups)
+    print '%d lookups' % len(lookups)
+    print 'memory:         %8.2f KB per lookup' % (
+        (after - before) / 1024.0 / max(len(lookups), 1))
+    if lookups:
+        print 'lookup objects: %8d bytes per lookup' % (
+            sum([instance_size(lookup) for lookup in lookups]) / len(lookups))
+        print 'field prototypes: %d' % len(set([id(lookup.field_to_add)
+                                                for lookup in lookups]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+Measures how long registering the indexes of many models takes at startup:
+
+eager     one register_index() call per lookup, each of them publishing the
+          registries of the backends
+lazy      lazy registration materialized in a single batch
+manifest  lazy registration rebuilt from a manifest, see dbindexer.manifest
+
+Every scenario runs in a process of its own, e.g.
+
+    python benchmarks/startup.py --models 300 --fields 5
+'''
+
+from optparse import OptionParser
+import common
+import os
+import tempfile
+import time
+
+def measure(scenario, options, manifest):
+    common.configure()
+    from dbindexer.api import register_index
+    from dbindexer.manifest import load_manifest, write_manifest
+    from dbindexer.resolver import resolver
+
+    models = common.create_models('Startup', options.models, options.fields)
+    names = common.field_names(options.fields)
+    started = time.time()
+    if scenario == 'eager':
+        for model in models:
+            for name in names:
+                for lookup in common.LOOKUPS:
+                    register_index(model, {name: lookup}, lazy=False)
+    else:
+        for model in models:
+            register_index(model, dict([(name, common.LOOKUPS)
+                                        for name in names]), lazy=True)
+        if scenario == 'manifest':
+            if not load_manifest(manifest):
+                raise SystemExit('The manifest doesn\'t match the models.')
+        else:
+            resolver.materialize(use_manifest=False)
+    seconds = time.time() - started
+    if scenario == 'lazy':
+        write_manifest(manifest)
+    print seconds
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--models', type='int', default=100,
+                      help='Number of models.')
+    parser.add_option('--fields', type='int', default=5,
+                      help='Indexed fields per model.')
+    parser.add_option('--scenario', help='Only measure this scenario.')
+    parser.add_option('--manifest', help='Path of the manifest.')
+    options, args = parser.parse_args()
+    if options.scenario:
+        measure(options.scenario, options, options.manifest)
+        return
+
+    fd, manifest = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        print '%d models, %d lookups' % (options.models,
+            options.models * options.fields * len(common.LOOKUPS))
+        # the lazy run writes the manifest
+        for scenario in ('lazy', 'manifest', 'eager'):
+            seconds = float(common.run_script(os.path.abspath(__file__),
+                '--models', str(options.models),
+                '--fields', str(options.fields),
+                '--scenario', scenario, '--manifest', manifest))
+            print '%-10s %8.3f s' % (scenario, seconds)
+    finally:
+        os.remove(manifest)
+
+if __name__ == '__main__':
+    main()
@@ -8,3 +8,6 @@ def load_indexes():
 
     for name in getattr(settings, 'DB_INDEX_MODULES', ()):
         import_module(name)
+
+# only used by Django versions with an app registry
+default_app_config = 'dbindexer.apps.DBIndexerConfig'
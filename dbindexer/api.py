@@ -1,17 +1,102 @@
-from .lookups import LookupDoesNotExist, ExtraFieldLookup
+from django.conf import settings
+from django.db.models import ForeignKey
+from .lookups import LookupDoesNotExist, ExtraFieldLookup, regex, \
+    EARTH_RADIUS, distance, dump_args
 from . import lookups as lookups_module
+from .explain import explain
 from .resolver import resolver
 import inspect
+import json
+import math
+
+# maps lookup definitions to the lookup classes matching them so we only have
+# to inspect lookups_module once per definition
+_lookup_classes = {}
 
 # TODO: add possibility to add lookup modules
 def create_lookup(lookup_def):
+    try:
+        cls = _lookup_classes.get(lookup_def)
+    except TypeError:
+        # unhashable lookup definition
+        cls = None
+    if cls is None:
+        cls = find_lookup_class(lookup_def)
+        try:
+            _lookup_classes[lookup_def] = cls
+        except TypeError:
+            pass
+    return cls()
+
+def find_lookup_class(lookup_def):
     for _, cls in inspect.getmembers(lookups_module):
         if inspect.isclass(cls) and issubclass(cls, ExtraFieldLookup) and \
                 cls.matches_lookup_def(lookup_def):
-            return cls()
+            return cls
     raise LookupDoesNotExist('No Lookup found for %s .' % lookup_def)
 
-def register_index(model, mapping):
+def registration_key(model, field_name, lookup, condition=None, version=None):
+    '''Returns a string identifying a single registered lookup.'''
+    if isinstance(lookup, ExtraFieldLookup):
+        args = sorted(dump_args(lookup).items())
+        lookup = '%s.%s' % (lookup.__class__.__module__,
+                            lookup.__class__.__name__)
+        # lookups with other arguments store other index values
+        if args:
+            lookup += '(%s)' % ','.join(['%s=%s' % (name,
+                json.dumps(value, sort_keys=True)) for name, value in args])
+    elif isinstance(lookup, regex):
+        lookup = '%s/%d' % (lookup.pattern, lookup.flags)
+    key = '%s.%s:%s:%s' % (model._meta.app_label, model._meta.object_name,
+                           field_name, lookup)
+    if condition:
+        key += '?%s' % '&'.join(['%s=%r' % item
+                                 for item in sorted(condition.items())])
+    if version is not None:
+        key += '#%d' % version
+    return key
+
+def registration_keys(model, mapping, condition=None, version=None):
+    keys = []
+    for field_name, lookups in mapping.items():
+        if not isinstance(lookups, (list, tuple)):
+            lookups = (lookups, )
+        for lookup in lookups:
+            keys.append((model, field_name,
+                         registration_key(model, field_name, lookup,
+                                          condition, version)))
+    return keys
+
+def register_index(model, mapping, lazy=None, condition=None, version=None):
+    '''
+    Registers the lookups in mapping on model. With lazy registration
+    (DBINDEXER_LAZY_REGISTRATION) the call is only recorded and the indexes
+    get created in one batch by resolver.materialize(). Raises
+    ImproperlyConfigured if none of DBINDEXER_BACKENDS handles a lookup.
+
+    condition maps field names to values, e.g. {'published': True}. Only
+    rows having these values get indexed (the others store None) and only
+    queries filtering on exactly these values use the indexes.
+
+    version adds a new version of the indexes, e.g. after changing their
+    lookups, with index fields of their own. Queries use them once
+    dbindexer_migrate filled them in for the existing rows, see
+    dbindexer.migration.
+    '''
+    if lazy is None:
+        lazy = getattr(settings, 'DBINDEXER_LAZY_REGISTRATION', False)
+    if lazy:
+        resolver.defer_index(model, mapping, condition, version)
+        return
+
+    # publish the indexes of all lookups at once
+    resolver.begin_batch()
+    try:
+        _register_index(model, mapping, condition, version)
+    finally:
+        resolver.end_batch()
+
+def _register_index(model, mapping, condition, version):
     for field_name, lookups in mapping.items():
         if not isinstance(lookups, (list, tuple)):
             lookups = (lookups, )
@@ -19,9 +104,64 @@ def register_index(model, mapping):
         # create indexes and add model and field_name to lookups
         # create ExtraFieldLookup instances on the fly if needed
         for lookup in lookups:
+            resolver.registrations.append((model, field_name,
+                registration_key(model, field_name, lookup, condition,
+                                 version)))
             lookup_def = None
             if not isinstance(lookup, ExtraFieldLookup):
                 lookup_def = lookup
                 lookup = create_lookup(lookup_def)
             lookup.contribute(model, field_name, lookup_def)
+            if condition:
+                lookup.condition = condition
+            lookup.version = version
+            # versions can change the lookup's arguments, e.g. its encoding
+            lookup.index_key = registration_key(model, field_name,
+                                                lookup.index_type, condition)
             resolver.create_index(lookup)
+
+def prefetch(queryset, *names):
+    '''
+    Returns a copy of queryset whose results get the objects of the
+    ForeignKeys names attached, fetched with one query per ForeignKey for
+    each DBINDEXER_PREFETCH_WINDOW results. Prefetching is a property of the
+    query which gets lost by cloning it, so call prefetch() last, e.g.
+    prefetch(Post.objects.filter(...)[:20], 'author').
+    '''
+    opts = queryset.model._meta
+    for name in names:
+        field = opts.get_field(name)
+        if not isinstance(field, ForeignKey):
+            raise ValueError('%s.%s isn\'t a ForeignKey.' % (
+                opts.object_name, name))
+    queryset = queryset._clone()
+    queryset.query.dbindexer_prefetch = names
+    return queryset
+
+def nearby(queryset, fields, point, radius):
+    '''
+    Yields the objects of queryset within radius meters of point, a
+    (latitude, longitude) tuple. fields are the names of the latitude and
+    longitude fields, which should be indexed by a GeoHash lookup. The query
+    filters on the bounding box of the circle, the distances get checked
+    while streaming its results.
+    '''
+    lat_name, lng_name = fields
+    lat, lng = point
+    angle = radius / EARTH_RADIUS
+    lat_range = (max(lat - math.degrees(angle), -90.0),
+                 min(lat + math.degrees(angle), 90.0))
+    lng_range = (-180.0, 180.0)
+    # boxes containing a pole or crossing the antimeridian span all longitudes
+    if -90.0 < lat_range[0] and lat_range[1] < 90.0:
+        delta = math.degrees(math.asin(min(1.0, math.sin(angle) /
+                                           math.cos(math.radians(lat)))))
+        if -180.0 <= lng - delta and lng + delta <= 180.0:
+            lng_range = (lng - delta, lng + delta)
+
+    queryset = queryset.filter(**{'%s__range' % lat_name: lat_range,
+                                  '%s__range' % lng_name: lng_range})
+    for obj in queryset.iterator():
+        if distance(lat, lng, getattr(obj, lat_name),
+                    getattr(obj, lng_name)) <= radius:
+            yield obj
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+class DBIndexerConfig(AppConfig):
+    name = 'dbindexer'
+
+    def ready(self):
+        from .resolver import resolver
+        resolver.materialize()
@@ -1,7 +1,10 @@
 import django
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from django.db import connections, models
 from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.aggregates import Count
+from django.db.models.sql.subqueries import DeleteQuery, UpdateQuery
 from django.utils.tree import Node
 
 try:
@@ -11,7 +14,14 @@ except ImportError:
 
 from djangotoolbox.fields import ListField
 
-from dbindexer.lookups import StandardLookup
+from dbindexer import explain, migration
+from dbindexer.lookups import StandardLookup, ConjunctionLookup, \
+    ReverseLookup, Aggregate, ReverseJOIN
+from collections import OrderedDict, deque
+from copy import copy
+import hashlib
+import threading
+import time
 
 if django.VERSION >= (1, 6):
     TABLE_NAME = 0
@@ -36,25 +46,325 @@ else:
     def join_cols(join_info):
         return (join_info[LHS_JOIN_COL], join_info[RHS_JOIN_COL])
 
+AND = 'AND'
 OR = 'OR'
 
+def add_residual_filters(query, residual):
+    '''
+    Adds (field, lookup_type, value) filters which the compiler applies to
+    the results because the database can't.
+    '''
+    if not hasattr(query, 'dbindexer_residual_filters'):
+        query.dbindexer_residual_filters = []
+    query.dbindexer_residual_filters.extend(residual)
+
+def supports_residual_filters(query):
+    '''Returns True if the compiler can apply residual filters to the
+    results of query.'''
+    # residual filters need all fields of the results and can't be applied
+    # to aggregates except counts
+    if isinstance(query, (UpdateQuery, DeleteQuery)):
+        return False
+    if is_count_query(query):
+        return not query.select
+    return query.default_cols and not query.aggregates
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def get_chunk_size():
+    return getattr(settings, 'DBINDEXER_CHUNK_SIZE', 100)
+
+def get_update_values(query):
+    '''Returns the new values of the fields updated by query by name.'''
+    values = {}
+    for field, _, value in query.values:
+        if hasattr(value, 'prepare_database_save'):
+            value = value.prepare_database_save(field)
+        values[field.name] = value
+    return values
+
+def is_expression(value):
+    '''Returns True if value is computed by the database, e.g. F('age') + 1.'''
+    return hasattr(value, 'evaluate')
+
+def is_count_query(query):
+    '''Returns True if query counts its rows, e.g. for QuerySet.count().'''
+    aggregates = query.aggregate_select.values()
+    return len(aggregates) == 1 and isinstance(aggregates[0], Count) and \
+        aggregates[0].col == '*' and not query.distinct and \
+        query.group_by is None
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker = threading.local()
+
+def run_in_worker(func, item, explanation=None):
+    '''Calls func and closes the connections it opened in this thread.'''
+    # queries made by func must not wait for the pool they are running in
+    _worker.active = True
+    explain.activate(explanation)
+    try:
+        return func(item)
+    finally:
+        explain.deactivate()
+        for connection in connections.all():
+            connection.close()
+
+def run_concurrently(func, items):
+    '''
+    Returns [func(item) for item in items]. The calls run in a shared pool of
+    DBINDEXER_JOIN_THREADS threads if there are several of them. Each thread
+    uses its own database connections, so this is disabled by default.
+    '''
+
+    global _pool
+    threads = getattr(settings, 'DBINDEXER_JOIN_THREADS', 0)
+    if threads < 2 or len(items) < 2 or getattr(_worker, 'active', False):
+        return [func(item) for item in items]
+
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(threads)
+    finally:
+        _pool_lock.release()
+    explanation = explain.current()
+    return _pool.map(lambda item: run_in_worker(func, item, explanation),
+                     items)
+
+def get_reverse_relation(model, name):
+    '''Returns the related object of the reverse relation of model with the
+    accessor or query name name or None.'''
+    for related in model._meta.get_all_related_objects():
+        if name in (related.get_accessor_name(),
+                    related.field.related_query_name()):
+            return related
+    return None
+
+def freeze(value):
+    '''Returns a hashable version of a lookup value or raises TypeError.'''
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(value)
+    hash(value)
+    return value
+
+def hashable(value):
+    '''Returns a hashable version of an index value keeping the order of
+    lists.'''
+    if isinstance(value, list):
+        return ('list', tuple([hashable(item) for item in value]))
+    return value
+
+class PKCache(object):
+    '''
+    Bounded LRU cache mapping a model and the lookup of a query on it to the
+    matching pks. Entries of a model get dropped when it is written to.
+    Writes also advance the generation of the model, so pks queried before
+    a write can't be stored after it invalidated the entries.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        # model -> number of writes
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, model, lookup):
+        try:
+            return model, frozenset([(name, freeze(value))
+                                     for name, value in lookup.items()])
+        except TypeError:
+            return None
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            pks = self.entries.pop(key, None)
+            if pks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = pks
+            return pks
+        finally:
+            self._lock.release()
+
+    def generation(self, key):
+        '''Returns the generation of the model of key, pass it to set().'''
+        return self.generations.get(key[0], 0)
+
+    def set(self, key, pks, generation):
+        self._lock.acquire()
+        try:
+            # the model was written to while querying pks
+            if self.generations.get(key[0], 0) != generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = pks
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, model):
+        # writes to a child model change the tables of its parents, too
+        models = set(model._meta.get_parent_list())
+        models.add(model)
+        self._lock.acquire()
+        try:
+            for model in models:
+                self.generations[model] = self.generations.get(model, 0) + 1
+            for key in self.entries.keys():
+                if key[0] in models:
+                    del self.entries[key]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': requests and float(self.hits) / requests or 0.0,
+                'size': len(self.entries)}
+
+class IndexRegistry(object):
+    '''
+    Snapshot of the indexes known by a backend. Snapshots never change once
+    published, registration publishes a new one instead. So queries can read
+    them without locking while other threads register indexes. Building a
+    snapshot takes time linear in the number of indexes, so registrations
+    get published in batches, see BaseResolver.begin_batch().
+    '''
+    __slots__ = ('index_map', 'lookups', 'writers', 'versioned', 'newer',
+                 'column_to_name')
+
+    def __init__(self, index_map=None, column_to_name=None):
+        # mapping from lookups to indexes
+        self.index_map = index_map or {}
+        self.lookups = tuple(self.index_map)
+        # one lookup per index field, lookups sharing an index field (see
+        # ExtraFieldLookup.encoding) write it only once
+        fields = set()
+        writers = []
+        for lookup in self.lookups:
+            if id(self.index_map[lookup]) not in fields:
+                fields.add(id(self.index_map[lookup]))
+                writers.append(lookup)
+        self.writers = tuple(writers)
+        # versions of an index share its index_key, see dbindexer.migration
+        self.versioned = tuple([lookup for lookup in self.lookups
+                                if lookup.version is not None])
+        versions = {}
+        for lookup in self.versioned:
+            versions.setdefault(lookup.index_key, []).append(lookup)
+        self.newer = {}
+        for lookup in self.lookups:
+            if lookup.index_key is None:
+                continue
+            newer = tuple([other for other in versions.get(lookup.index_key,
+                                                           ())
+                           if other.version > lookup.version])
+            if newer:
+                self.newer[lookup] = newer
+        # mapping from column names to field names
+        self.column_to_name = column_to_name or {}
+
 # TODO: optimize code
 class BaseResolver(object):
     def __init__(self):
-        # mapping from lookups to indexes
-        self.index_map = {}
-        # mapping from column names to field names
-        self.column_to_name = {}
+        self.registry = IndexRegistry()
+        self._registry_lock = threading.RLock()
+        # (index_map, column_to_name) of the open batch
+        self._staged = None
+        self._batch_depth = 0
+
+    # copies, registries must not change once published
+
+    @property
+    def index_map(self):
+        return dict(self.registry.index_map)
+
+    @property
+    def column_to_name(self):
+        return dict(self.registry.column_to_name)
+
+    def begin_batch(self):
+        '''
+        Stages the additions of update_registry() until the matching
+        end_batch() call publishes them in a single registry. Batches can be
+        nested and block registrations in other threads until they end.
+        '''
+        self._registry_lock.acquire()
+        if not self._batch_depth:
+            self._staged = (dict(self.registry.index_map),
+                            dict(self.registry.column_to_name))
+        self._batch_depth += 1
+
+    def end_batch(self):
+        try:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                index_map, column_to_name = self._staged
+                self._staged = None
+                self.registry = IndexRegistry(index_map, column_to_name)
+        finally:
+            self._registry_lock.release()
+
+    def update_registry(self, index_map=None, column_to_name=None):
+        '''Adds to the registry. The additions get published at the end of
+        the open batch or right away without one.'''
+        self.begin_batch()
+        try:
+            self._staged[0].update(index_map or {})
+            self._staged[1].update(column_to_name or {})
+        finally:
+            self.end_batch()
 
     ''' API called by resolver'''
 
     def create_index(self, lookup):
+        '''Installs the index of lookup. Returns True if the backend
+        handles lookup.'''
         field_to_index = self.get_field_to_index(lookup.model, lookup.field_name)
 
         # backend doesn't now how to handle this index definition
         if not field_to_index:
-            return
+            return False
+
+        if self.install_index(lookup, field_to_index):
+            self.add_column_to_name(lookup.model, lookup.field_name)
+        return True
+
+    def install_index(self, lookup, field_to_index):
+        '''Adds the index field of lookup to its model. Returns False if the
+        lookup is installed already.'''
+
+        index_field = self.get_index_field(lookup, field_to_index)
+
+        self.begin_batch()
+        try:
+            # don't install a field if it already exists
+            try:
+                lookup.model._meta.get_field(self.index_name(lookup))
+            except:
+                lookup.model.add_to_class(self.index_name(lookup), index_field)
+            else:
+                # makes dbindexer unit test compatible
+                if lookup in self._staged[0]:
+                    return False
+                index_field = lookup.model._meta.get_field(
+                    self.index_name(lookup))
+            self.update_registry(index_map={lookup: index_field})
+        finally:
+            self.end_batch()
+        return True
 
+    def get_index_field(self, lookup, field_to_index):
         index_field = lookup.get_field_to_add(field_to_index)
         config_field = index_field.item_field if \
             isinstance(index_field, ListField) else index_field
@@ -62,31 +372,21 @@ class BaseResolver(object):
                 isinstance(config_field, models.CharField):
             config_field.max_length = field_to_index.max_length
 
+        self.check_field_to_index(lookup, field_to_index)
+        return index_field
+
+    def check_field_to_index(self, lookup, field_to_index):
         if isinstance(field_to_index,
             (models.DateField, models.DateTimeField, models.TimeField)):
             if field_to_index.auto_now or field_to_index.auto_now_add:
                 raise ImproperlyConfigured('\'auto_now\' and \'auto_now_add\' '
                     'on %s.%s is not supported by dbindexer.' %
-                    (lookup.model._meta.object_name, lookup.field_name))
-
-        # don't install a field if it already exists
-        try:
-            lookup.model._meta.get_field(self.index_name(lookup))
-        except:
-            lookup.model.add_to_class(self.index_name(lookup), index_field)
-            self.index_map[lookup] = index_field
-            self.add_column_to_name(lookup.model, lookup.field_name)
-        else:
-            # makes dbindexer unit test compatible
-            if lookup not in self.index_map:
-                self.index_map[lookup] = lookup.model._meta.get_field(
-                    self.index_name(lookup))
-                self.add_column_to_name(lookup.model, lookup.field_name)
+                    (lookup.model._meta.object_name, field_to_index.name))
 
     def convert_insert_query(self, query):
         '''Converts a database saving query.'''
 
-        for lookup in self.index_map.keys():
+        for lookup in self.get_writers():
             self._convert_insert_query(query, lookup)
 
     def _convert_insert_query(self, query, lookup):
@@ -97,14 +397,25 @@ class BaseResolver(object):
         if position is None:
             return
 
+        # rows not matching the condition of a partial index store None
+        matches = [self.matches_condition(lookup, obj) for obj in query.objs]
+        for obj, match in zip(query.objs, matches):
+            if not match:
+                setattr(obj, self.get_index(lookup).attname, None)
+        if True not in matches:
+            return
+
         value = self.get_value(lookup.model, lookup.field_name, query)
 
         if isinstance(value, list):
             for i in range(0, len(value)):
-                setattr(query.objs[i], lookup.index_name, lookup.convert_value(value[i]))
+                if matches[i]:
+                    setattr(query.objs[i], self.index_name(lookup),
+                            lookup.convert_value(value[i]))
         else:
             try:
-                setattr(query.objs[0], lookup.index_name, lookup.convert_value(value))
+                setattr(query.objs[0], self.index_name(lookup),
+                        lookup.convert_value(value))
             except ValueError, e:
                 '''
                 If lookup.index_name is a foreign key field, we need to set the actual
@@ -120,12 +431,167 @@ class BaseResolver(object):
 
                 index_field = lookup.get_field_to_add(field_to_index)
                 if isinstance(index_field, models.ForeignKey):
-                    setattr(query.objs[0], '%s_id' % lookup.index_name, lookup.convert_value(value))
+                    setattr(query.objs[0], '%s_id' % self.index_name(lookup),
+                            lookup.convert_value(value))
                 else:
                     raise
 
+    def convert_update_query(self, query):
+        '''
+        Adds the new index values to an update query. Returns (backend,
+        lookup) for all indexes which can't be computed from the update,
+        e.g. because of F() expressions, and have to be recomputed for each
+        updated object.
+        '''
+        return self._convert_update_query(query, self.get_writers())
+
+    def _convert_update_query(self, query, lookups):
+        values = get_update_values(query)
+        stale = []
+        for lookup in lookups:
+            if lookup.model != query.model:
+                continue
+            name = self.get_source_field(lookup).name
+            condition = lookup.condition or {}
+            if name not in values and \
+                    not [key for key in condition if key in values]:
+                continue
+            # partial indexes depend on the values of each row
+            if condition or is_expression(values[name]):
+                stale.append((self, lookup))
+                continue
+            query.add_update_fields([(self.get_index(lookup), None,
+                self.convert_source_value(lookup, values[name]))])
+        return stale
+
+    def index_value(self, lookup, obj):
+        '''Returns the value of lookup's index field for obj.'''
+        if not self.matches_condition(lookup, obj):
+            return None
+        value = self.get_source_field(lookup).value_from_object(obj)
+        return self.convert_source_value(lookup, value)
+
+    def matches_condition(self, lookup, obj):
+        '''Returns True if obj has to be indexed by lookup.'''
+        for name, value in (lookup.condition or {}).items():
+            if lookup.model._meta.get_field(name).value_from_object(obj) \
+                    != value:
+                return False
+        return True
+
+    def condition_holds(self, query, lookup):
+        '''Returns True if the filters of query imply the condition of
+        lookup, so its partial index contains all rows query can match.'''
+        if not lookup.condition:
+            return True
+        base_alias = query.table_map[query.model._meta.db_table][0]
+        values = {}
+        for _, child in get_conjunction(query.where):
+            constraint, lookup_type, _, value = child
+            if constraint.field is None or constraint.alias != base_alias:
+                continue
+            if lookup_type == 'isnull' and value:
+                value = None
+            elif lookup_type != 'exact':
+                continue
+            values.setdefault(constraint.field.name, []).append(value)
+        for name, value in lookup.condition.items():
+            if value not in values.get(name, ()):
+                return False
+        return True
+
+    def migration_key(self, lookup):
+        '''Returns the key of the migration state of a versioned index.'''
+        if lookup.version is None:
+            return None
+        return '%s.%s:%s' % (lookup.model._meta.app_label,
+                             lookup.model._meta.object_name,
+                             self.index_name(lookup))
+
+    def can_read(self, query, lookup):
+        '''Returns True if query can be converted to use lookup's index, i.e.
+        its condition holds and it's the readable version of the index.'''
+        if not self.condition_holds(query, lookup):
+            return False
+        newer = self.registry.newer.get(lookup, ())
+        if lookup.version is None and not newer:
+            return True
+        return migration.is_readable(self.migration_key(lookup),
+            [self.migration_key(other) for other in newer])
+
+    def get_writers(self):
+        '''Returns the lookups whose index fields have to be written, which
+        excludes index versions replaced by a migrated one.'''
+        registry = self.registry
+        if not registry.newer:
+            return registry.writers
+        return [lookup for lookup in registry.writers
+                if lookup not in registry.newer or migration.is_writable(
+                    [self.migration_key(other)
+                     for other in registry.newer[lookup]])]
+
+    def get_backfill_model(self, lookup):
+        '''Returns the model whose rows backfill() gets called with.'''
+        return lookup.model
+
+    def backfill(self, lookup, objs):
+        '''Writes lookup's index values of existing rows, see
+        dbindexer.migration. Skips rows storing the right value already and
+        returns the number of rows written.'''
+        attname = self.get_index(lookup).attname
+        return self.write_changed(lookup, dict([(obj.pk,
+            (self.index_value(lookup, obj), getattr(obj, attname)))
+            for obj in objs]))
+
+    def write_changed(self, lookup, values):
+        '''Takes (new value, stored value) of lookup's rows by pk, writes the
+        changed ones and returns their number.'''
+        changed = dict([(pk, value) for pk, (value, stored) in values.items()
+                        if hashable(value) != hashable(stored)])
+        self.update_index_values(lookup, changed)
+        return len(changed)
+
+    def update_index_values(self, lookup, values):
+        '''Writes the index values of lookup's rows given by pk. Rows with
+        equal values get written by a single update, the others by concurrent
+        ones, see run_concurrently().'''
+        groups = {}
+        for pk, value in values.items():
+            groups.setdefault(hashable(value), (value, []))[1].append(pk)
+        manager = lookup.model._base_manager
+        field = self.get_index(lookup)
+
+        def update(group):
+            value, pks = group
+            # index names of conjunctions contain '__', so update by field
+            manager.filter(pk__in=pks)._update([(field, None, value)])
+        run_concurrently(update, groups.values())
+
+    def get_source_field(self, lookup):
+        '''Returns the field of lookup.model the index value depends on.'''
+        return lookup.model._meta.get_field(lookup.field_name)
+
+    def convert_source_value(self, lookup, value):
+        return lookup.convert_value(value)
+
     def convert_filters(self, query):
         self._convert_filters(query, query.where)
+        self.convert_ordering(query)
+
+    def get_dependents(self, query):
+        '''
+        Returns (backend, dependent) for all indexes of other models which
+        depend on the rows changed by the update or delete query. The
+        backend has to implement get_dependent_field() and
+        refresh_dependents(), which get passed the dependent, see
+        ReverseRelationResolver and ConstantFieldJOINResolver.
+        '''
+        return []
+
+    def notify_write(self, query, operation):
+        '''Called after query wrote to the database. operation is 'insert',
+        'update' or 'delete'.'''
+        pass
 
     ''' helper methods '''
 
@@ -146,29 +612,82 @@ class BaseResolver(object):
         if constraint.field is None:
             return
 
-        field_name = self.column_to_name.get(constraint.field.column)
+        registry = self.registry
+        field_name = registry.column_to_name.get(constraint.field.column)
         if field_name and constraint.alias == \
                 query.table_map[query.model._meta.db_table][0]:
-            for lookup in self.index_map.keys():
+            for lookup in registry.lookups:
                 if lookup.matches_filter(query.model, field_name, lookup_type,
-                                         value):
+                                         value) and \
+                        self.can_read(query, lookup):
                     new_lookup_type, new_value = lookup.convert_lookup(value,
                                                                        lookup_type)
                     index_name = self.index_name(lookup)
                     self._convert_filter(query, filters, child, index,
-                                         new_lookup_type, new_value, index_name)
+                                         new_lookup_type, new_value, index_name,
+                                         lookup)
+
+    def convert_ordering(self, query):
+        '''Rewrites orderings by transformed or JOINed fields into orderings
+        by their index fields, so the database can sort and limit.'''
+
+        ordering = query.order_by
+        if not ordering and query.default_ordering:
+            ordering = query.get_meta().ordering
+        if not ordering:
+            return
+
+        new_ordering = [self.convert_order(query, item) for item in ordering]
+        if new_ordering != list(ordering):
+            query.order_by = new_ordering
+
+    def convert_order(self, query, item):
+        if not isinstance(item, basestring) or item == '?':
+            return item
+        prefix = item.startswith('-') and '-' or ''
+        name = item.lstrip('-+')
+        for lookup in self.registry.lookups:
+            if lookup.matches_ordering(query.model, name) and \
+                    self.can_read(query, lookup):
+                new_item = prefix + self.index_name(lookup)
+                explanation = explain.current()
+                if explanation is not None:
+                    explanation.orderings.append((item, new_item))
+                return new_item
+        return item
 
     def _convert_filter(self, query, filters, child, index, new_lookup_type,
-                        new_value, index_name):
+                        new_value, index_name, lookup=None):
+        explanation = explain.current()
+        if explanation is not None:
+            explanation.add_rewrite(self, child, index_name, new_lookup_type,
+                                    new_value, lookup)
         constraint, lookup_type, annotation, value = child
         lookup_type, value = new_lookup_type, new_value
         constraint.field = query.get_meta().get_field(index_name)
         constraint.col = constraint.field.column
+        # empty lists are 'in' filters matching nothing, an AND node without
+        # children would match everything
+        if lookup is not None and lookup.matches_all_values and \
+                isinstance(value, list) and value:
+            # one filter per value, all of them have to match
+            node = query.where_class(connector=AND)
+            node.children = [(copy(constraint), lookup_type, annotation, val)
+                             for val in value]
+            filters.children[index] = node
+            return
         child = constraint, lookup_type, annotation, value
         filters.children[index] = child
 
     def index_name(self, lookup):
-        return lookup.index_name
+        name = lookup.index_name
+        if lookup.condition:
+            # partial indexes only share fields with the same condition
+            name += '_c%s' % hashlib.md5(repr(sorted(
+                lookup.condition.items()))).hexdigest()[:8]
+        if lookup.version is not None:
+            name += '_v%d' % lookup.version
+        return name
 
     def get_field_to_index(self, model, field_name):
         try:
@@ -176,6 +695,10 @@ class BaseResolver(object):
         except:
             return None
 
+    def get_index_target(self, lookup):
+        '''Returns the model and name of the field indexed by lookup.'''
+        return lookup.model, lookup.field_name
+
     def get_value(self, model, field_name, query):
         field_to_index = self.get_field_to_index(model, field_name)
 
@@ -190,10 +713,10 @@ class BaseResolver(object):
 
     def add_column_to_name(self, model, field_name):
         column_name = model._meta.get_field(field_name).column
-        self.column_to_name[column_name] = field_name
+        self.update_registry(column_to_name={column_name: field_name})
 
     def get_index(self, lookup):
-        return self.index_map[lookup]
+        return self.registry.index_map[lookup]
 
     def get_query_position(self, query, lookup):
         for index, field in enumerate(query.fields):
@@ -205,6 +728,9 @@ def unref_alias(query, alias):
     table_name = query.alias_map[alias][TABLE_NAME]
     query.alias_refcount[alias] -= 1
     if query.alias_refcount[alias] < 1:
+        explanation = explain.current()
+        if explanation is not None:
+            explanation.removed_joins.append(table_name)
         # Remove all information about the join
         del query.alias_refcount[alias]
         if hasattr(query, 'rev_join_map'):
@@ -265,18 +791,314 @@ class FKNullFix(BaseResolver):
         constraint.col = constraint.field.column
         constraint.alias = alias
 
+class InequalityResolver(BaseResolver):
+    '''
+    Backends like App Engine only allow inequality filters on a single
+    property. If a query has inequality filters on several fields only those
+    on one field are kept. The others become residual filters which the
+    compiler applies to the results. Add this backend after the backends
+    converting lookups to index fields.
+    '''
+
+    inequalities = ('gt', 'gte', 'lt', 'lte', 'range')
+
+    def create_index(self, lookup):
+        pass
+
+    def convert_insert_query(self, query):
+        pass
+
+    def convert_filters(self, query):
+        where = query.where
+        if not supports_residual_filters(query):
+            return
+        if where.negated or (where.connector == OR and
+                             len(where.children) > 1):
+            return
+
+        base_alias = query.table_map[query.model._meta.db_table][0]
+        fields = {}
+        for child in where.children:
+            if isinstance(child, Node) or (SubqueryConstraint is not None and
+                    isinstance(child, SubqueryConstraint)):
+                continue
+            constraint, lookup_type, annotation, value = child
+            if constraint.field is None or constraint.alias != base_alias or \
+                    lookup_type not in self.inequalities:
+                continue
+            fields.setdefault(constraint.col, []).append(child)
+        if len(fields) < 2:
+            return
+
+        column = self.choose_inequality(query, fields)
+        residual = []
+        moved = set()
+        explanation = explain.current()
+        for children in [fields[col] for col in fields if col != column]:
+            for child in children:
+                residual.append((child[0].field, child[1], child[3]))
+                moved.add(id(child))
+                if explanation is not None:
+                    explanation.residual_filters.append(
+                        explain.describe_child(child))
+        where.children = [child for child in where.children
+                          if id(child) not in moved]
+        add_residual_filters(query, residual)
+
+    def choose_inequality(self, query, fields):
+        '''
+        Returns the column whose inequality filters stay in the query. Some
+        backends require the first ordering to be on the inequality field, so
+        that one wins. Otherwise filters bounded on both sides are expected
+        to be the most selective ones.
+        '''
+
+        ordering = query.order_by or (query.default_ordering and
+                                      query.get_meta().ordering) or ()
+        if ordering:
+            name = ordering[0].lstrip('-')
+            for column, children in fields.items():
+                if name in (children[0][0].field.name,
+                            children[0][0].field.attname):
+                    return column
+
+        def bounds(children):
+            lookup_types = set([child[1] for child in children])
+            return ('range' in lookup_types or
+                    (lookup_types & set(['gt', 'gte']) and
+                     lookup_types & set(['lt', 'lte']))) and 1 or 0
+        return max(fields.keys(), key=lambda column: bounds(fields[column]))
+
+def get_conjunction(filters):
+    '''Returns (node, child) for all leaves which have to match together
+    with filters, so they can be combined into a single filter.'''
+    if filters.negated or (filters.connector == OR and
+                           len(filters.children) > 1):
+        return []
+    leaves = []
+    for child in filters.children:
+        if isinstance(child, Node):
+            leaves.extend(get_conjunction(child))
+        elif SubqueryConstraint is None or \
+                not isinstance(child, SubqueryConstraint):
+            leaves.append((filters, child))
+    return leaves
+
+def prune(filters):
+    '''Removes nodes left empty by combining their children.'''
+    for child in filters.children[:]:
+        if isinstance(child, Node):
+            prune(child)
+            if not child.children:
+                filters.children.remove(child)
+
+class ConjunctionResolver(BaseResolver):
+    '''
+    Maintains ConjunctionLookups (e.g. Composite), which index several fields
+    of a model in a single field. A conjunction of filters on these fields
+    gets rewritten into one filter on the index field. Add this backend
+    before the backends converting single lookups.
+    '''
+
+    def create_index(self, lookup):
+        if not isinstance(lookup, ConjunctionLookup):
+            return False
+        self.install_index(lookup, self.get_fields_to_index(lookup)[0])
+        return True
+
+    def get_fields_to_index(self, lookup):
+        fields = []
+        for field_name in lookup.field_names:
+            field = self.get_field_to_index(lookup.model, field_name)
+            if field is None or isinstance(field, ListField):
+                raise ImproperlyConfigured('%s can\'t index %s.%s, only local '
+                    'fields which aren\'t ListFields are supported.' %
+                    (lookup.__class__.__name__,
+                     lookup.model._meta.object_name, field_name))
+            fields.append(field)
+        return fields
+
+    def get_index_field(self, lookup, field_to_index):
+        for field in self.get_fields_to_index(lookup):
+            self.check_field_to_index(lookup, field)
+        return lookup.get_field_to_add(field_to_index)
+
+    def get_index_target(self, lookup):
+        return lookup.model, lookup.field_names[0]
+
+    def convert_insert_query(self, query):
+        for lookup in self.get_writers():
+            if lookup.model != query.model or \
+                    self.get_query_position(query, lookup) is None:
+                continue
+            for obj in query.objs:
+                setattr(obj, self.index_name(lookup),
+                        self.index_value(lookup, obj))
+
+    def _convert_update_query(self, query, lookups):
+        values = get_update_values(query)
+        stale = []
+        for lookup in lookups:
+            names = lookup.field_names
+            if lookup.model != query.model or not [name for name in
+                    list(names) + list(lookup.condition or ()) if name in values]:
+                continue
+            if lookup.condition or [name for name in names if
+                    name not in values or is_expression(values[name])]:
+                stale.append((self, lookup))
+                continue
+            query.add_update_fields([(self.get_index(lookup), None,
+                lookup.convert_value([values[name] for name in names]))])
+        return stale
+
+    def index_value(self, lookup, obj):
+        if not self.matches_condition(lookup, obj):
+            return None
+        return lookup.convert_value([field.value_from_object(obj)
+                                     for field in self.get_fields_to_index(lookup)])
+
+    def convert_filters(self, query):
+        lookups = [lookup for lookup in self.registry.lookups
+                   if lookup.model == query.model and
+                   self.can_read(query, lookup)]
+        if not lookups:
+            return
+
+        base_alias = query.table_map[query.model._meta.db_table][0]
+        leaves = []
+        for node, child in get_conjunction(query.where):
+            constraint = child[0]
+            if constraint.field is not None and \
+                    constraint.alias == base_alias:
+                leaves.append((node, child))
+
+        # use the lookup combining most of the filters
+        best = None
+        filters = [(child[0].field.name, child[1], child[3])
+                   for _, child in leaves]
+        for lookup in lookups:
+            match = lookup.convert_filters(filters)
+            if match and (best is None or len(match[0]) > len(best[1][0])):
+                best = lookup, match
+        if best is None:
+            return
+
+        lookup, (positions, new_lookup_type, new_value) = best
+        combined = [leaves[position] for position in positions]
+        node, child = combined[0]
+        if lookup.residual:
+            if supports_residual_filters(query):
+                self.move_to_residual(query, [item for _, item in combined])
+            else:
+                # keep the filters, the index filter only narrows them down
+                child = (copy(child[0]), ) + child[1:]
+                node.children.append(child)
+                combined = [(node, child)]
+        index = [id(item) for item in node.children].index(id(child))
+        self._convert_filter(query, node, child, index, new_lookup_type,
+                             new_value, self.index_name(lookup), lookup)
+        for node, child in combined[1:]:
+            node.children = [item for item in node.children
+                             if item is not child]
+        prune(query.where)
+
+    def move_to_residual(self, query, children):
+        explanation = explain.current()
+        if explanation is not None:
+            explanation.residual_filters.extend([explain.describe_child(child)
+                                                 for child in children])
+        add_residual_filters(query, [(child[0].field, child[1], child[3])
+                                     for child in children])
+
 class ConstantFieldJOINResolver(BaseResolver):
     def create_index(self, lookup):
-        if '__' in lookup.field_name:
-            super(ConstantFieldJOINResolver, self).create_index(lookup)
+        if '__' not in lookup.field_name:
+            return False
+        return super(ConstantFieldJOINResolver, self).create_index(lookup)
 
     def convert_insert_query(self, query):
         '''Converts a database saving query.'''
 
-        for lookup in self.index_map.keys():
+        for lookup in self.get_writers():
             if '__' in lookup.field_name:
                 self._convert_insert_query(query, lookup)
 
+    def convert_update_query(self, query):
+        return self._convert_update_query(query, [lookup
+            for lookup in self.get_writers() if '__' in lookup.field_name])
+
+    def get_source_field(self, lookup):
+        # the index value depends on the first ForeignKey of the chain
+        return lookup.model._meta.get_field(lookup.field_name.split('__')[0])
+
+    def convert_source_value(self, lookup, value):
+        if value is not None:
+            value = self.get_target_value(lookup.model, lookup.field_name,
+                                          value)
+        return lookup.convert_value(value)
+
+    def get_dependents(self, query):
+        # deleting JOINed rows deletes the JOINing ones or sets their foreign
+        # keys to None by queries of their own
+        if not isinstance(query, UpdateQuery):
+            return []
+        values = get_update_values(query)
+        dependents = []
+        for lookup in self.get_writers():
+            if '__' not in lookup.field_name:
+                continue
+            names = lookup.field_name.split('__')
+            model_chain = self.get_model_chain(lookup.model, lookup.field_name)
+            for level in range(1, len(model_chain)):
+                if model_chain[level] == query.model and \
+                        names[level] in values:
+                    dependents.append((self, (lookup, level)))
+        return dependents
+
+    def get_dependent_field(self, dependent):
+        lookup, level = dependent
+        return self.get_model_chain(lookup.model,
+                                    lookup.field_name)[level]._meta.pk
+
+    def refresh_dependents(self, dependent, pks):
+        '''
+        Recomputes the index values of the rows JOINing the rows with the
+        given pks at the level of the dependent. The JOINing rows get found
+        level by level, reading DBINDEXER_CHUNK_SIZE pks at a time, and
+        target values get read once per foreign key value.
+        '''
+        lookup, level = dependent
+        names = lookup.field_name.split('__')
+        model_chain = self.get_model_chain(lookup.model, lookup.field_name)
+        for model, name in reversed(zip(model_chain[1:level],
+                                        names[1:level])):
+            pks = self.get_joining_pks(model, name, pks)
+
+        source = self.get_source_field(lookup)
+        attname = self.get_index(lookup).attname
+        manager = lookup.model._base_manager
+        targets = {}
+        for chunk in chunked(list(pks), get_chunk_size()):
+            values = {}
+            for obj in manager.filter(**{'%s__in' % source.name: chunk}):
+                value = None
+                if self.matches_condition(lookup, obj):
+                    target = source.value_from_object(obj)
+                    if target not in targets:
+                        targets[target] = self.convert_source_value(lookup,
+                                                                    target)
+                    value = targets[target]
+                values[obj.pk] = (value, getattr(obj, attname))
+            self.write_changed(lookup, values)
+
+    def get_joining_pks(self, model, name, pks):
+        '''Returns the pks of model's rows whose field name is in pks.'''
+        joining = []
+        for chunk in chunked(list(pks), get_chunk_size()):
+            joining.extend(model._base_manager.filter(**{
+                '%s__in' % name: chunk}).values_list('pk', flat=True))
+        return joining
+
     def convert_filter(self, query, filters, child, index):
         constraint, lookup_type, annotation, value = child
         field_chain = self.get_field_chain(query, constraint)
@@ -284,22 +1106,32 @@ class ConstantFieldJOINResolver(BaseResolver):
         if field_chain is None:
             return
 
-        for lookup in self.index_map.keys():
+        for lookup in self.registry.lookups:
             if lookup.matches_filter(query.model, field_chain, lookup_type,
-                                     value):
+                                     value) and \
+                    self.can_read(query, lookup):
                 self.resolve_join(query, child)
                 new_lookup_type, new_value = lookup.convert_lookup(value,
                                                                    lookup_type)
                 index_name = self.index_name(lookup)
                 self._convert_filter(query, filters, child, index,
-                                     new_lookup_type, new_value, index_name)
+                                     new_lookup_type, new_value, index_name,
+                                     lookup)
 
     def get_field_to_index(self, model, field_name):
-        model = self.get_model_chain(model, field_name)[-1]
+        try:
+            model = self.get_model_chain(model, field_name)[-1]
+        except FieldDoesNotExist:
+            # e.g. chains starting with a reverse relation
+            return None
         field_name = field_name.split('__')[-1]
         return super(ConstantFieldJOINResolver, self).get_field_to_index(model,
             field_name)
 
+    def get_index_target(self, lookup):
+        model = self.get_model_chain(lookup.model, lookup.field_name)[-1]
+        return model, lookup.field_name.split('__')[-1]
+
     def get_value(self, model, field_name, query):
         value = super(ConstantFieldJOINResolver, self).get_value(model,
                                     field_name.split('__')[0],
@@ -316,7 +1148,7 @@ class ConstantFieldJOINResolver(BaseResolver):
             return
 
         column_index = self.get_column_index(query, constraint)
-        return self.column_to_name.get(column_index)
+        return self.registry.column_to_name.get(column_index)
 
     def get_model_chain(self, model, field_chain):
         model_chain = [model, ]
@@ -349,7 +1181,7 @@ class ConstantFieldJOINResolver(BaseResolver):
         field_names = field_name.split('__')
         for model, name in zip(model_chain, field_names):
             column_chain += model._meta.get_field(name).column + '__'
-        self.column_to_name[column_chain[:-2]] = field_name
+        self.update_registry(column_to_name={column_chain[:-2]: field_name})
 
     def unref_alias(self, query, alias):
         unref_alias(query, alias)
@@ -386,47 +1218,77 @@ class ConstantFieldJOINResolver(BaseResolver):
 # TODO: distinguish in memory joins from standard joins somehow
 class InMemoryJOINResolver(ConstantFieldJOINResolver):
     def __init__(self):
-        self.field_chains = []
         super(InMemoryJOINResolver, self).__init__()
+        # caches the pks of intermediate JOIN queries, see PKCache
+        size = getattr(settings, 'DBINDEXER_JOIN_CACHE_SIZE', 0)
+        self.pk_cache = size and PKCache(size) or None
 
     def create_index(self, lookup):
         if '__' in lookup.field_name:
             field_to_index = self.get_field_to_index(lookup.model, lookup.field_name)
 
             if not field_to_index:
-                return
+                return False
 
             # save old column_to_name so we can make in memory queries later on
             self.add_column_to_name(lookup.model, lookup.field_name)
 
             # don't add an extra field for standard lookups!
             if isinstance(lookup, StandardLookup):
-                return
+                return True
 
             # install lookup on target model
             model = self.get_model_chain(lookup.model, lookup.field_name)[-1]
             lookup.model = model
             lookup.field_name = lookup.field_name.split('__')[-1]
-            super(ConstantFieldJOINResolver, self).create_index(lookup)
+            # conditions refer to fields of the JOINing model, so all target
+            # rows get indexed
+            lookup.condition = None
+            return super(ConstantFieldJOINResolver, self).create_index(lookup)
+        return False
 
     def convert_insert_query(self, query):
         super(ConstantFieldJOINResolver, self).convert_insert_query(query)
 
+    def convert_update_query(self, query):
+        return super(ConstantFieldJOINResolver, self).convert_update_query(
+            query)
+
+    def notify_write(self, query, operation):
+        if self.pk_cache is not None:
+            self.pk_cache.invalidate(query.model)
+
     def _convert_filters(self, query, filters):
-        # or queries are not supported for in-memory-JOINs
         if self.contains_OR(query.where, OR):
-            return
+            return self._convert_OR_filters(query, filters)
 
         # start with the deepest JOIN level filter!
         all_filters = self.get_all_filters(filters)
         all_filters.sort(key=lambda item: self.get_field_chain(query, item[1][0]) and \
                          -len(self.get_field_chain(query, item[1][0])) or 0)
 
-        for filters, child, index in all_filters:
-            # check if convert_filter removed a given child from the where-tree
+        # Plan the queries of all JOINs first. Children which can be resolved
+        # in a single query per JOIN level get combined into one plan while
+        # planning, so the remaining plans don't depend on each other and can
+        # be fetched concurrently.
+        joins = []
+        for node, child, index in all_filters:
+            # check if combining filters removed a given child from the tree
             if not self.contains_child(query.where, child):
                 continue
-            self.convert_filter(query, filters, child, index)
+            field_chain = self.get_field_chain(query, child[0])
+            if field_chain is None:
+                continue
+            if '__' not in field_chain:
+                super(ConstantFieldJOINResolver, self).convert_filter(query,
+                    node, child, self.child_index(node, child))
+                continue
+            joins.append((child, field_chain, self.plan_pks(query,
+                field_chain, child[1], child[3])))
+
+        # JOINs via the same foreign key get merged into the intersection of
+        # their pk sets
+        self.resolve_joins(query, filters, joins)
 
     def convert_filter(self, query, filters, child, index):
         constraint, lookup_type, annotation, value = child
@@ -444,6 +1306,114 @@ class InMemoryJOINResolver(ConstantFieldJOINResolver):
         self._convert_filter(query, filters, child, index, 'in',
                              (pk for pk in pks), field_chain.split('__')[0])
 
+    def _convert_OR_filters(self, query, filters):
+        '''
+        Resolves the JOIN of every child on its own, so the children of OR
+        nodes don't get combined with their siblings. Children JOINing via the
+        same foreign key are merged into a single filter afterwards.
+        '''
+
+        joins = []
+        for node, child, index in self.get_all_filters(filters):
+            field_chain = self.get_field_chain(query, child[0])
+            if field_chain is None:
+                continue
+            if '__' not in field_chain:
+                super(ConstantFieldJOINResolver, self).convert_filter(query,
+                    node, child, index)
+                continue
+            joins.append((child, field_chain, self.plan_pks(query,
+                field_chain, child[1], child[3], combine=False)))
+        self.resolve_joins(query, filters, joins)
+
+    def resolve_joins(self, query, filters, joins):
+        '''Fetches the pks of the planned (child, field_chain, steps) joins
+        and replaces the children by filters on them.'''
+
+        pk_sets = {}
+        for (child, field_chain, _), pks in zip(joins, run_concurrently(
+                self.fetch_pks, [steps for _, _, steps in joins])):
+            self.joined(query, field_chain, child[1], pks)
+            pk_sets[id(child)] = (field_chain, pks)
+        self.merge_pk_filters(query, filters, pk_sets)
+
+    def joined(self, query, field_chain, lookup_type, pks):
+        '''Called with the pks a JOIN of query got resolved to.'''
+        pass
+
+    def merge_pk_filters(self, query, filters, pk_sets):
+        '''
+        Replaces the children in pk_sets by an 'in' filter on their foreign
+        key. Children of a node JOINing via the same foreign key become a
+        single filter on the union (OR) or intersection (AND) of their pks.
+        Children of an OR node JOINing via different foreign keys become a
+        single filter on the pks of the queried model.
+        '''
+
+        children = []
+        merged = {}
+        for child in filters.children:
+            # Q objects wrap single filters in nodes of their own
+            while isinstance(child, Node) and len(child.children) == 1 and \
+                    not child.negated:
+                child = child.children[0]
+            if isinstance(child, Node):
+                self.merge_pk_filters(query, child, pk_sets)
+            elif id(child) in pk_sets:
+                field_chain, pks = pk_sets[id(child)]
+                self.resolve_join(query, child)
+                foreign_key = field_chain.split('__')[0]
+                if foreign_key in merged:
+                    position = merged[foreign_key]
+                    if filters.connector == OR:
+                        children[position][3].update(pks)
+                    else:
+                        children[position][3].intersection_update(pks)
+                    continue
+
+                merged[foreign_key] = len(children)
+                explanation = explain.current()
+                if explanation is not None:
+                    explanation.add_rewrite(self, child, foreign_key, 'in',
+                                            pks)
+                constraint = child[0]
+                constraint.field = query.get_meta().get_field(foreign_key)
+                constraint.col = constraint.field.column
+                child = constraint, 'in', child[2], set(pks)
+            children.append(child)
+
+        for position in merged.values():
+            constraint, lookup_type, annotation, pks = children[position]
+            children[position] = constraint, lookup_type, annotation, list(pks)
+        if filters.connector == OR and len(merged) > 1:
+            children = self.merge_foreign_keys(query, children, merged)
+        filters.children = children
+
+    def merge_foreign_keys(self, query, children, merged):
+        '''Replaces the merged 'in' filters on different foreign keys of an
+        OR node by one filter on the union of the pks of the queried model,
+        as nonrel backends can't OR filters on different fields.'''
+
+        pks = set()
+        for foreign_key, position in merged.items():
+            if children[position][3]:
+                pks.update(self.query_pks(query.model,
+                    {'%s__in' % foreign_key: children[position][3]}))
+
+        positions = sorted(merged.values())
+        constraint, _, annotation, _ = children[positions[0]]
+        explanation = explain.current()
+        if explanation is not None:
+            explanation.add_rewrite(self, children[positions[0]],
+                                    query.get_meta().pk.name, 'in', pks)
+        constraint.field = query.get_meta().pk
+        constraint.col = constraint.field.column
+        new_children = [child for position, child in enumerate(children)
+                        if position not in positions]
+        new_children.insert(positions[0], (constraint, 'in', annotation,
+                                           list(pks)))
+        return new_children
+
     def tree_contains(self, filters, to_find, func):
         result = False
         for child in filters.children[:]:
@@ -463,6 +1433,11 @@ class InMemoryJOINResolver(ConstantFieldJOINResolver):
     def contains_child(self, filters, to_find):
         return self.tree_contains(filters, to_find, lambda c, f: c is f)
 
+    def child_index(self, filters, to_find):
+        for index, child in enumerate(filters.children):
+            if child is to_find:
+                return index
+
     def get_all_filters(self, filters):
         all_filters = []
         for index, child in enumerate(filters.children[:]):
@@ -476,25 +1451,75 @@ class InMemoryJOINResolver(ConstantFieldJOINResolver):
     def index_name(self, lookup):
         # use another index_name to avoid conflicts with lookups defined on the
         # target model which are handled by the BaseBackend
-        return lookup.index_name + '_in_memory_join'
+        return super(InMemoryJOINResolver, self).index_name(lookup) + \
+            '_in_memory_join'
+
+    def get_pks(self, query, field_chain, lookup_type, value, combine=True):
+        return self.fetch_pks(self.plan_pks(query, field_chain, lookup_type,
+                                            value, combine=combine))
+
+    def plan_pks(self, query, field_chain, lookup_type, value, combine=True):
+        '''
+        Returns the queries resolving field_chain as (model, lookup, pk_filter)
+        steps starting at the deepest JOIN level. pk_filter is the filter
+        which gets the pks of the previous step. Children combined into these
+        queries are removed from the where-tree, so only fetch_pks may run in
+        another thread.
+        '''
 
-    def get_pks(self, query, field_chain, lookup_type, value):
         model_chain = self.get_model_chain(query.model, field_chain)
 
         first_lookup = {'%s__%s' %(field_chain.rsplit('__', 1)[-1],
                                    lookup_type): value}
-        self.combine_with_same_level_filter(first_lookup, query, field_chain)
-        pks = model_chain[-1].objects.all().filter(**first_lookup).values_list(
-            'id', flat=True)
+        if combine:
+            self.combine_with_same_level_filter(first_lookup, query, field_chain)
+        steps = [(model_chain[-1], first_lookup, None)]
 
         chains = [field_chain.rsplit('__', i+1)[0]
                   for i in range(field_chain.count('__'))]
-        lookup = {}
         for model, chain in reversed(zip(model_chain[1:-1], chains[:-1])):
-            lookup.update({'%s__%s' %(chain.rsplit('__', 1)[-1], 'in'):
-                           (pk for pk in pks)})
-            self.combine_with_same_level_filter(lookup, query, chain)
-            pks = model.objects.all().filter(**lookup).values_list('id', flat=True)
+            lookup = {}
+            if combine:
+                self.combine_with_same_level_filter(lookup, query, chain)
+            steps.append((model, lookup,
+                          '%s__%s' %(chain.rsplit('__', 1)[-1], 'in')))
+        return steps
+
+    def fetch_pks(self, steps):
+        pks = None
+        for model, lookup, pk_filter in steps:
+            if pk_filter:
+                # no need to query further levels without any matching pk
+                if not pks:
+                    return frozenset()
+                lookup = dict(lookup)
+                lookup[pk_filter] = list(pks)
+            pks = self.query_pks(model, lookup)
+        return pks
+
+    def query_pks(self, model, lookup):
+        key = None
+        if self.pk_cache is not None:
+            key = self.pk_cache.key(model, lookup)
+            if key is not None:
+                generation = self.pk_cache.generation(key)
+                pks = self.pk_cache.get(key)
+                if pks is not None:
+                    explanation = explain.current()
+                    if explanation is not None:
+                        explanation.add_join_query(model, lookup, pks, 0,
+                                                   cached=True)
+                    return pks
+
+        started = time.time()
+        pks = frozenset(model.objects.all().filter(**lookup).values_list('id',
+            flat=True))
+        explanation = explain.current()
+        if explanation is not None:
+            explanation.add_join_query(model, lookup, pks,
+                                       time.time() - started)
+        if key is not None:
+            self.pk_cache.set(key, pks, generation)
         return pks
 
     def combine_with_same_level_filter(self, lookup, query, field_chain):
@@ -546,3 +1571,356 @@ class InMemoryJOINResolver(ConstantFieldJOINResolver):
             if field_chain:
                 field_chains[field_chain] = child
         return field_chains
+
+class PlannedInMemoryJOINResolver(InMemoryJOINResolver):
+    def __init__(self, planner):
+        super(PlannedInMemoryJOINResolver, self).__init__()
+        self.planner = planner
+
+    def joined(self, query, field_chain, lookup_type, pks):
+        self.planner.record_join(query.model, field_chain, lookup_type,
+                                 len(pks))
+
+class CostBasedJOINResolver(BaseResolver):
+    '''
+    Installs JOIN indexes for both ConstantFieldJOINResolver and
+    InMemoryJOINResolver and picks the cheaper one for each JOINed filter.
+    Costs are measured in queries, 'in' filters get split into a query per
+    30 values by some backends. Denormalized indexes need the queries of
+    their converted filter. In-memory JOINs need the queries of the filter
+    on the JOINed model, of filtering each further level and the query
+    itself by the averaged number of JOINed pks and save the JOIN queries
+    answered by the pk cache (DBINDEXER_JOIN_CACHE_SIZE). So small cached
+    JOINs beat denormalized indexes filtering by many values.
+
+    Updates of JOINed rows refresh the denormalized index values of the
+    rows JOINing them, see ConstantFieldJOINResolver.get_dependents(), so
+    denormalized indexes stay current as long as all processes write
+    through dbindexer. Statistics only cover the JOINs of this process.
+    '''
+
+    # cost of filtering by a single value of an 'in' filter
+    pk_cost = 1.0 / 30
+    # expected number of pks of a JOIN without statistics
+    default_pks = 30
+    # weight of the latest JOIN in the averaged number of pks
+    pks_weight = 0.2
+    # number of decisions kept for inspection
+    history_size = 100
+
+    def __init__(self):
+        super(CostBasedJOINResolver, self).__init__()
+        self.denormalized = ConstantFieldJOINResolver()
+        self.in_memory = PlannedInMemoryJOINResolver(self)
+        self.backends = (self.denormalized, self.in_memory)
+        # (model, field_chain, lookup_type) -> averaged number of JOINed pks
+        self.statistics = {}
+        self.decisions = deque(maxlen=self.history_size)
+
+    def create_index(self, lookup):
+        if '__' not in lookup.field_name:
+            return False
+        denormalized = self.denormalized.create_index(lookup)
+        # InMemoryJOINResolver moves lookups to the JOINed model
+        in_memory = self.in_memory.create_index(copy(lookup))
+        return denormalized or in_memory
+
+    def convert_insert_query(self, query):
+        self.denormalized.convert_insert_query(query)
+        self.in_memory.convert_insert_query(query)
+
+    def convert_update_query(self, query):
+        return self.denormalized.convert_update_query(query) + \
+            self.in_memory.convert_update_query(query)
+
+    def get_dependents(self, query):
+        return self.denormalized.get_dependents(query)
+
+    def notify_write(self, query, operation):
+        self.in_memory.notify_write(query, operation)
+
+    def convert_filters(self, query):
+        for node, child, index in self.in_memory.get_all_filters(query.where):
+            if SubqueryConstraint is not None and \
+                    isinstance(child, SubqueryConstraint):
+                continue
+            field_chain = self.denormalized.get_field_chain(query, child[0])
+            if not field_chain or '__' not in field_chain:
+                continue
+            if self.choose(query, field_chain, child[1], child[3]) == \
+                    'denormalized':
+                self.denormalized.convert_filter(query, node, child,
+                    self.in_memory.child_index(node, child))
+
+        # all remaining JOINs get resolved in memory
+        self.in_memory.convert_filters(query)
+        self.denormalized.convert_ordering(query)
+
+    def choose(self, query, field_chain, lookup_type, value):
+        models = self.denormalized.get_model_chain(query.model, field_chain)[1:]
+        denormalized_cost = None
+        for lookup in self.denormalized.registry.lookups:
+            if lookup.matches_filter(query.model, field_chain, lookup_type,
+                                     value) and \
+                    self.denormalized.can_read(query, lookup):
+                denormalized_cost = self.filter_cost(
+                    *lookup.convert_lookup(value, lookup_type))
+                break
+
+        pks = self.statistics.get((query.model, field_chain, lookup_type),
+                                  self.default_pks)
+        hit_rate = 0.0
+        if self.in_memory.pk_cache is not None:
+            hit_rate = self.in_memory.pk_cache.stats()['hit_rate']
+        join_cost = self.filter_cost(lookup_type, value) + \
+            (len(models) - 1) * self.filter_cost('in', pks)
+        in_memory_cost = (1 - hit_rate) * join_cost + \
+            self.filter_cost('in', pks)
+
+        if denormalized_cost is not None and \
+                denormalized_cost <= in_memory_cost:
+            strategy = 'denormalized'
+        else:
+            strategy = 'in_memory'
+        self.decisions.append({
+            'model': query.model, 'field_chain': field_chain,
+            'lookup_type': lookup_type, 'strategy': strategy,
+            'denormalized_cost': denormalized_cost,
+            'in_memory_cost': in_memory_cost,
+        })
+        return strategy
+
+    def filter_cost(self, lookup_type, value):
+        '''Returns the number of queries filtering by value takes, value is
+        the number of values of 'in' filters.'''
+        if lookup_type != 'in':
+            return 1
+        if not isinstance(value, (int, long, float)):
+            value = len(value)
+        return max(1, value * self.pk_cost)
+
+    def record_join(self, model, field_chain, lookup_type, pks):
+        key = (model, field_chain, lookup_type)
+        if key in self.statistics:
+            pks = (1 - self.pks_weight) * self.statistics[key] + \
+                self.pks_weight * pks
+        self.statistics[key] = pks
+
+class ReverseRelationResolver(BaseResolver):
+    '''
+    Maintains ReverseLookups, whose index values on a parent model are
+    computed from the rows of a reverse relation. Inserted rows get merged
+    into the stored values of their parents, see merge_inserted(). Updated
+    and deleted rows make the index values of their parents get recomputed
+    from all of their related rows. Parents are read DBINDEXER_CHUNK_SIZE at
+    a time and parents with equal index values get written by a single
+    update.
+    '''
+    lookup_class = ReverseLookup
+
+    def create_index(self, lookup):
+        if not isinstance(lookup, self.lookup_class):
+            return False
+        if lookup.condition:
+            raise ImproperlyConfigured('%s doesn\'t support conditions.' %
+                                       lookup.__class__.__name__)
+        self.install_index(lookup, self.get_target_field(lookup))
+        return True
+
+    def get_index_field(self, lookup, field_to_index):
+        return lookup.get_field_to_add(field_to_index)
+
+    def get_index_target(self, lookup):
+        target_field = self.get_target_field(lookup)
+        return target_field.model, target_field.name
+
+    def get_relation(self, lookup):
+        '''Returns the model and the foreign key of the rows of lookup's
+        reverse relation.'''
+        related = get_reverse_relation(lookup.model, lookup.relation_name)
+        if related is not None:
+            return related.model, related.field
+        raise ImproperlyConfigured('%s has no reverse relation %s.' %
+            (lookup.model._meta.object_name, lookup.relation_name))
+
+    def get_target_field(self, lookup):
+        '''Returns the field of the related rows lookup depends on, which
+        is their pk if lookup doesn't name one.'''
+        model, _ = self.get_relation(lookup)
+        if len(lookup.field_name) > 2:
+            raise ImproperlyConfigured('%s can\'t index %s.%s, only fields '
+                'of the related rows are supported.' % (
+                lookup.__class__.__name__, lookup.model._meta.object_name,
+                '__'.join(lookup.field_name)))
+        if lookup.target_name is None:
+            return model._meta.pk
+        return model._meta.get_field(lookup.target_name)
+
+    def convert_insert_query(self, query):
+        # new parents get the default values of the index fields
+        pass
+
+    def convert_update_query(self, query):
+        return []
+
+    def get_dependents(self, query):
+        values = None
+        if isinstance(query, UpdateQuery):
+            values = get_update_values(query)
+        dependents = []
+        for lookup in self.get_writers():
+            model, foreign_key = self.get_relation(lookup)
+            if model != query.model:
+                continue
+            if values is not None and foreign_key.name not in values and \
+                    self.get_target_field(lookup).name not in values:
+                continue
+            dependents.append((self, lookup))
+        return dependents
+
+    def get_dependent_field(self, lookup):
+        return self.get_relation(lookup)[1]
+
+    def refresh_dependents(self, lookup, pks):
+        '''Recomputes the index values of the parents with the given pks
+        from all of their related rows.'''
+        for chunk in chunked(list(pks), get_chunk_size()):
+            self.update_index_values(lookup,
+                                     self.compute_dependents(lookup, chunk))
+
+    def compute_dependents(self, lookup, pks):
+        '''Returns the index values of the parents with the given pks by pk.'''
+        model, foreign_key = self.get_relation(lookup)
+        target_field = self.get_target_field(lookup)
+        children = dict([(pk, []) for pk in pks])
+        for pk, value in model._base_manager.filter(**{
+                '%s__in' % foreign_key.name: pks}).values_list(
+                foreign_key.name, target_field.name):
+            children[pk].append(value)
+        return dict([(pk, lookup.convert_value(values))
+                     for pk, values in children.items()])
+
+    def notify_write(self, query, operation):
+        if operation == 'insert':
+            self.refresh_inserted(query)
+
+    def refresh_inserted(self, query):
+        for lookup in self.get_writers():
+            model, foreign_key = self.get_relation(lookup)
+            if model != query.model:
+                continue
+            target_field = self.get_target_field(lookup)
+            values = {}
+            for obj in query.objs:
+                pk = getattr(obj, foreign_key.attname)
+                if pk is not None:
+                    values.setdefault(pk, []).append(
+                        target_field.value_from_object(obj))
+            if values:
+                self.merge_inserted(lookup, values)
+
+    def merge_inserted(self, lookup, values):
+        '''
+        Merges the values of inserted related rows, given as lists by parent
+        pk, into the stored index values of the parents without reading
+        their other related rows. Parents with equal stored and new values
+        get written by a single update, which only writes parents still
+        storing the value read before. If another writer changed one of
+        them in between, the parents of the update get recomputed from all
+        of their related rows.
+
+        ListFields (ReverseJOIN) can't be compared that way. Inserts racing
+        each other can lose the values of one of them until the parent gets
+        recomputed, e.g. by updating or deleting one of its related rows or
+        by backfilling the index, see dbindexer.migration.
+        '''
+        field = self.get_index(lookup)
+        manager = lookup.model._base_manager
+        for chunk in chunked(values.keys(), get_chunk_size()):
+            groups = {}
+            for pk, stored in manager.filter(pk__in=chunk).values_list(
+                    'pk', field.name):
+                value = lookup.merge(stored, values[pk])
+                groups.setdefault((hashable(stored), hashable(value)),
+                                  (stored, value, []))[2].append(pk)
+            for stored, value, pks in groups.values():
+                rows = manager.filter(pk__in=pks)
+                if not isinstance(stored, list):
+                    rows = rows.filter(**{field.name: stored})
+                if rows._update([(field, None, value)]) < len(pks):
+                    self.refresh_dependents(lookup, pks)
+
+    def backfill(self, lookup, objs):
+        attname = self.get_index(lookup).attname
+        stored = dict([(obj.pk, getattr(obj, attname)) for obj in objs])
+        return self.write_changed(lookup, dict([(pk, (value, stored[pk]))
+            for pk, value in self.compute_dependents(lookup,
+                                                     stored.keys()).items()]))
+
+class AggregateResolver(ReverseRelationResolver):
+    '''
+    Maintains Aggregate lookups, e.g. {'post_set': 'count'}, so parents can
+    be filtered and ordered by aggregates of their related rows without
+    fetching them.
+    '''
+    lookup_class = Aggregate
+
+class ReverseJOINResolver(ReverseRelationResolver):
+    '''
+    Converts filters on reverse relations, e.g.
+    ForeignIndexed2.objects.filter(idx_set__name__iexact='itachi'), into
+    filters on a ListField of the parent containing the converted values of
+    all of its related rows. Register the lookups on the parent, e.g.
+    {'idx_set__name': 'iexact'}. Several filters on the same relation can be
+    matched by different related rows.
+    '''
+    lookup_class = ReverseJOIN
+
+    def create_index(self, lookup):
+        if isinstance(lookup, (ReverseLookup, ConjunctionLookup)) or \
+                '__' not in lookup.field_name:
+            return False
+        if get_reverse_relation(lookup.model,
+                                lookup.field_name.split('__')[0]) is None:
+            return False
+        # the other backends keep using lookup
+        reverse_lookup = ReverseJOIN(lookup=copy(lookup))
+        reverse_lookup.contribute(lookup.model, lookup.field_name,
+                                  lookup.lookup_def)
+        reverse_lookup.condition = lookup.condition
+        reverse_lookup.version = lookup.version
+        reverse_lookup.index_key = lookup.index_key
+        return super(ReverseJOINResolver, self).create_index(reverse_lookup)
+
+    def convert_filter(self, query, filters, child, index):
+        constraint, lookup_type, annotation, value = child
+        if constraint.field is None:
+            return
+
+        base_alias = query.table_map[query.model._meta.db_table][0]
+        join = query.alias_map.get(constraint.alias)
+        if join is None or join[LHS_ALIAS] != base_alias or \
+                join[JOIN_TYPE] != 'INNER JOIN':
+            return
+
+        for lookup in self.registry.lookups:
+            if lookup.model != query.model:
+                continue
+            model, foreign_key = self.get_relation(lookup)
+            if join[TABLE_NAME] != model._meta.db_table or \
+                    join_cols(join)[1] != foreign_key.column:
+                continue
+            field_chain = '%s__%s' % (lookup.relation_name,
+                                      constraint.field.name)
+            if lookup.matches_filter(query.model, field_chain, lookup_type,
+                                     value) and \
+                    self.can_read(query, lookup):
+                unref_alias(query, constraint.alias)
+                constraint.alias = base_alias
+                new_lookup_type, new_value = lookup.convert_lookup(value,
+                                                                   lookup_type)
+                self._convert_filter(query, filters, child, index,
+                                     new_lookup_type, new_value,
+                                     self.index_name(lookup), lookup)
+                return
+
@@ -1,6 +1,14 @@
 from django.conf import settings
 from django.utils.importlib import import_module
 
+# Classes generated for the target backends. Connections are created per
+# thread, so the classes get shared instead of being created again for each
+# connection.
+_wrapper_classes = {}
+_operations_classes = {}
+_compiler_classes = {}
+# alias -> (settings_dict, target_settings, merged settings)
+_merged_settings = {}
 
 def merge_dicts(d1, d2):
     '''Update dictionary recursively. If values for a given key exist in both dictionaries and are dict-like they are merged.'''
@@ -19,38 +27,62 @@ def merge_dicts(d1, d2):
 class DatabaseOperations(object):
     dbindexer_compiler_module = __name__.rsplit('.', 1)[0] + '.compiler'
 
-    def __init__(self):
-        self._dbindexer_cache = {}
-
     def compiler(self, compiler_name):
-        if compiler_name not in self._dbindexer_cache:
-            target = super(DatabaseOperations, self).compiler(compiler_name)
+        target = super(DatabaseOperations, self).compiler(compiler_name)
+        key = (self.dbindexer_compiler_module, compiler_name, target)
+        try:
+            return _compiler_classes[key]
+        except KeyError:
             base = getattr(
                 import_module(self.dbindexer_compiler_module), compiler_name)
             class Compiler(base, target):
                 pass
-            self._dbindexer_cache[compiler_name] = Compiler
-        return self._dbindexer_cache[compiler_name]
+            return _compiler_classes.setdefault(key, Compiler)
+
+def get_operations_class(ops_class):
+    try:
+        return _operations_classes[ops_class]
+    except KeyError:
+        class Operations(DatabaseOperations, ops_class):
+            pass
+        return _operations_classes.setdefault(ops_class, Operations)
 
 class BaseDatabaseWrapper(object):
     def __init__(self, *args, **kwargs):
         super(BaseDatabaseWrapper, self).__init__(*args, **kwargs)
-        class Operations(DatabaseOperations, self.ops.__class__):
+        self.ops.__class__ = get_operations_class(self.ops.__class__)
+
+def get_wrapper_class(engine):
+    try:
+        return _wrapper_classes[engine]
+    except KeyError:
+        target = import_module(engine + '.base').DatabaseWrapper
+        class Wrapper(BaseDatabaseWrapper, target):
             pass
-        self.ops.__class__ = Operations
-        self.ops.__init__()
+        return _wrapper_classes.setdefault(engine, Wrapper)
 
-def DatabaseWrapper(settings_dict, *args, **kwargs):
-    target_settings = settings_dict['TARGET']
-    if isinstance(target_settings, (str, unicode)):
-        target_settings = settings.DATABASES[target_settings]
-    engine = target_settings['ENGINE'] + '.base'
-    target = import_module(engine).DatabaseWrapper
-    class Wrapper(BaseDatabaseWrapper, target):
-        pass
+def get_merged_settings(settings_dict, target_settings, alias):
+    cached = _merged_settings.get(alias)
+    if cached is not None and cached[0] is settings_dict and \
+            cached[1] is target_settings:
+        return cached[2]
 
     # Update settings with target database settings (which can contain nested dicts).
     merged_settings = settings_dict.copy()
     merge_dicts(merged_settings, target_settings)
+    _merged_settings[alias] = (settings_dict, target_settings,
+                               merged_settings)
+    return merged_settings
+
+def DatabaseWrapper(settings_dict, *args, **kwargs):
+    target_settings = settings_dict['TARGET']
+    if isinstance(target_settings, (str, unicode)):
+        target_settings = settings.DATABASES[target_settings]
+    Wrapper = get_wrapper_class(target_settings['ENGINE'])
 
+    # connections of an alias share their settings like they do without
+    # dbindexer
+    alias = args and args[0] or kwargs.get('alias')
+    merged_settings = get_merged_settings(settings_dict, target_settings,
+                                          alias)
     return Wrapper(merged_settings, *args, **kwargs)
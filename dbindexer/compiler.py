@@ -1,5 +1,13 @@
+from .backends import chunked, get_chunk_size, get_update_values, \
+    hashable, is_count_query, is_expression
+from .explain import copy_constraints
 from .resolver import resolver
+from django.conf import settings
+from django.db.models.signals import post_init
+from django.db.models.sql.constants import MULTI, SINGLE
+from django.db.models.sql.query import Query
 from django.utils.importlib import import_module
+import threading
 
 def __repr__(self):
     return '<%s, %s, %s, %s>' % (self.alias, self.col, self.field.name,
@@ -8,45 +16,390 @@ def __repr__(self):
 from django.db.models.sql.where import Constraint
 Constraint.__repr__ = __repr__
 
-# TODO: manipulate a copy of the query instead of the query itself. This has to
-# be done because the query can be reused afterwards by the user so that a
-# manipulated query can result in strange behavior for these cases!
 # TODO: Add watching layer which gives suggestions for indexes via query inspection
 # at runtime
 
+def matches_residual_filter(value, lookup_type, filter_value):
+    if value is None:
+        return False
+    if lookup_type == 'exact':
+        return value == filter_value
+    if lookup_type == 'gt':
+        return value > filter_value
+    if lookup_type == 'gte':
+        return value >= filter_value
+    if lookup_type == 'lt':
+        return value < filter_value
+    if lookup_type == 'lte':
+        return value <= filter_value
+    if lookup_type == 'range':
+        return filter_value[0] <= value <= filter_value[1]
+    raise ValueError('Unsupported residual filter %s.' % lookup_type)
+
+def clone_query(query):
+    '''
+    Returns a copy of query whose filters can be converted without changing
+    query. Querysets reuse their query, e.g. when filtering, ordering or
+    slicing an evaluated queryset, so rewrites and residual filters must not
+    end up in it.
+    '''
+    clone = query.clone()
+    copy_constraints(clone.where)
+    # unref_alias() removes aliases from the lists of table_map
+    clone.table_map = dict([(table, list(aliases))
+                            for table, aliases in clone.table_map.items()])
+    prefetch = getattr(query, 'dbindexer_prefetch', None)
+    if prefetch:
+        clone.dbindexer_prefetch = prefetch
+    return clone
+
+# (model, [(foreign key, {value: related object}), ...]) of the windows
+# prefetched by the active results_iter() calls of this thread
+_prefetched = threading.local()
+
+def attach_prefetched(sender, instance, **kwargs):
+    '''Caches the prefetched related objects of a new model instance.'''
+    for model, relations in getattr(_prefetched, 'active', ()):
+        if not isinstance(instance, model):
+            continue
+        for field, objects in relations:
+            obj = objects.get(getattr(instance, field.attname, None))
+            if obj is not None:
+                setattr(instance, field.get_cache_name(), obj)
+
+def windowed(rows, size):
+    '''Yields lists of size rows read from the iterator rows.'''
+    window = []
+    for row in rows:
+        window.append(row)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
 class BaseCompiler(object):
     def convert_filters(self):
+        # compilers can be called several times for the same query, e.g.
+        # has_results() and results_iter()
+        if getattr(self, '_filters_converted', False):
+            return
         resolver.convert_filters(self.query)
+        self._filters_converted = True
+
+    def get_rows(self, names):
+        '''Returns the values of the given fields of the rows matching the
+        filters of the query.'''
+        query = self.query.clone(klass=Query)
+        query.extra = {}
+        query.select = []
+        query.add_fields(names)
+        return list(query.get_compiler(self.using).results_iter())
+
+    def get_dependent_pks(self, dependents):
+        '''
+        Returns a set for each of the (backend, lookup) pairs returned by
+        resolver.get_dependents() containing the values of its dependent
+        field, i.e. the pks of the rows whose index values have to be
+        recomputed.
+        '''
+        rows = self.get_rows([backend.get_dependent_field(lookup).name
+                              for backend, lookup in dependents])
+        return [set([row[position] for row in rows
+                     if row[position] is not None])
+                for position in range(len(dependents))]
+
+    def refresh_dependents(self, dependents, pk_sets):
+        for (backend, lookup), pks in zip(dependents, pk_sets):
+            if pks:
+                backend.refresh_dependents(lookup, pks)
 
 class SQLCompiler(BaseCompiler):
-    def execute_sql(self, *args, **kwargs):
+    # AggregateQuery.clone() loses the subquery, its filters are converted
+    # with the subquery's query instead
+    clone_query = True
+
+    def convert_filters(self):
+        if self.clone_query and not getattr(self, '_filters_converted',
+                                            False):
+            self.query = clone_query(self.query)
+        super(SQLCompiler, self).convert_filters()
+
+    def execute_sql(self, result_type=MULTI, *args, **kwargs):
+        self.convert_filters()
+        residual = getattr(self.query, 'dbindexer_residual_filters', None)
+        if residual and result_type == SINGLE and is_count_query(self.query):
+            return (self.residual_count(residual), )
+        return super(SQLCompiler, self).execute_sql(result_type, *args,
+                                                    **kwargs)
+
+    def as_sql(self, *args, **kwargs):
+        # used by subqueries, e.g. pk__in=queryset
         self.convert_filters()
-        return super(SQLCompiler, self).execute_sql(*args, **kwargs)
+        return super(SQLCompiler, self).as_sql(*args, **kwargs)
 
     def results_iter(self):
         self.convert_filters()
-        return super(SQLCompiler, self).results_iter()
+        residual = getattr(self.query, 'dbindexer_residual_filters', None)
+        if residual:
+            rows = self.residual_results_iter(residual)
+        else:
+            rows = super(SQLCompiler, self).results_iter()
+        prefetch = getattr(self.query, 'dbindexer_prefetch', None)
+        if prefetch:
+            return self.prefetch_results_iter(rows, prefetch)
+        return rows
 
     def has_results(self):
         self.convert_filters()
+        if getattr(self.query, 'dbindexer_residual_filters', None):
+            for row in self.results_iter():
+                return True
+            return False
         return super(SQLCompiler, self).has_results()
 
+    def residual_count(self, residual):
+        '''
+        Counts the rows matching the residual filters. Only the pk and the
+        filtered fields get loaded, so backends can run keys-only queries if
+        there's nothing to filter on.
+        '''
+
+        query = self.query
+        state = (query.aggregates, query.aggregate_select_mask,
+                 query.deferred_loading, query.default_cols)
+        query.aggregates = type(query.aggregates)()
+        query.set_aggregate_mask(None)
+        query.clear_deferred_loading()
+        query.add_immediate_loading([query.get_meta().pk.name] +
+            [field.name for field, _, _ in residual])
+        query.default_cols = True
+        try:
+            count = 0
+            for _ in self.residual_results_iter(residual):
+                count += 1
+            return count
+        finally:
+            query.aggregates, mask, query.deferred_loading, \
+                query.default_cols = state
+            query.set_aggregate_mask(mask)
+
+    def residual_results_iter(self, residual):
+        '''
+        Streams the results matching the residual filters the database
+        couldn't apply. The query's limits are applied to the matching rows,
+        so rows are fetched in growing batches until enough of them matched.
+        '''
+
+        if hasattr(self, 'get_fields'):
+            fields = self.get_fields()
+        else:
+            fields = self.query.get_meta().fields
+        columns = [field.column for field in fields]
+        residual = [(columns.index(field.column), lookup_type, value)
+                    for field, lookup_type, value in residual]
+
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        skip = low_mark
+        remaining = None
+        if high_mark is not None:
+            remaining = high_mark - low_mark
+        batch_size = getattr(settings, 'DBINDEXER_RESIDUAL_BATCH_SIZE', 100)
+        size = batch_size
+        if remaining is not None:
+            size = max(size, 2 * (skip + remaining))
+        offset = 0
+        try:
+            while True:
+                self.query.clear_limits()
+                self.query.set_limits(offset, offset + size)
+                count = 0
+                for row in super(SQLCompiler, self).results_iter():
+                    count += 1
+                    for position, lookup_type, value in residual:
+                        if not matches_residual_filter(row[position],
+                                                       lookup_type, value):
+                            break
+                    else:
+                        if skip:
+                            skip -= 1
+                            continue
+                        yield row
+                        if remaining is not None:
+                            remaining -= 1
+                            if not remaining:
+                                return
+                if count < size:
+                    return
+                offset += size
+                size = min(2 * size, 16 * batch_size)
+        finally:
+            self.query.low_mark, self.query.high_mark = low_mark, high_mark
+
+    def prefetch_results_iter(self, rows, names):
+        '''
+        Streams rows in windows of DBINDEXER_PREFETCH_WINDOW rows. The objects
+        referenced by the ForeignKeys names of each window get fetched with
+        a single query per ForeignKey and attached to the model instances
+        created from its rows, see api.prefetch().
+        '''
+
+        if hasattr(self, 'get_fields'):
+            fields = self.get_fields()
+        else:
+            fields = self.query.get_meta().fields
+        columns = [field.column for field in fields]
+        opts = self.query.get_meta()
+        foreign_keys = []
+        for name in names:
+            field = opts.get_field(name)
+            # deferred ForeignKeys don't get prefetched
+            if field.column in columns:
+                foreign_keys.append((field, columns.index(field.column)))
+
+        post_init.connect(attach_prefetched, dispatch_uid='dbindexer.prefetch')
+        size = getattr(settings, 'DBINDEXER_PREFETCH_WINDOW', 100)
+        active = getattr(_prefetched, 'active', None)
+        if active is None:
+            active = _prefetched.active = []
+        entry = None
+        try:
+            for window in windowed(rows, size):
+                relations = self.prefetch_window(window, foreign_keys)
+                if entry is not None:
+                    active.remove(entry)
+                entry = (self.query.model, relations)
+                active.append(entry)
+                for row in window:
+                    yield row
+        finally:
+            if entry is not None:
+                active.remove(entry)
+
+    def prefetch_window(self, window, foreign_keys):
+        '''Returns (foreign key, {value: related object}) for the objects
+        referenced by the rows in window.'''
+        relations = []
+        for field, position in foreign_keys:
+            values = set([row[position] for row in window
+                          if row[position] is not None])
+            if not values:
+                continue
+            target = field.rel.get_related_field()
+            objects = field.rel.to._base_manager.using(self.using).filter(
+                **{'%s__in' % target.name: list(values)})
+            relations.append((field, dict([(getattr(obj, target.attname), obj)
+                                           for obj in objects])))
+        return relations
+
 class SQLInsertCompiler(BaseCompiler):
     def execute_sql(self, return_id=False):
         resolver.convert_insert_query(self.query)
-        return super(SQLInsertCompiler, self).execute_sql(return_id=return_id)
+        result = super(SQLInsertCompiler, self).execute_sql(return_id=return_id)
+        resolver.notify_write(self.query, 'insert')
+        return result
 
 class SQLUpdateCompiler(BaseCompiler):
-    pass
+    def execute_sql(self, *args, **kwargs):
+        self.convert_filters()
+        stale = resolver.convert_update_query(self.query)
+        dependents = resolver.get_dependents(self.query)
+        # the update can change which objects match its filters
+        pks = None
+        if stale:
+            pks = self.get_pks()
+        pk_sets = dependents and self.get_dependent_pks(dependents) or None
+        result = super(SQLUpdateCompiler, self).execute_sql(*args, **kwargs)
+        if pks:
+            self.update_indexes(stale, pks)
+        if dependents:
+            self.add_updated_pks(dependents, pk_sets)
+            self.refresh_dependents(dependents, pk_sets)
+        resolver.notify_write(self.query, 'update')
+        return result
+
+    def get_pks(self):
+        return [row[0] for row in
+                self.get_rows([self.query.get_meta().pk.name])]
+
+    def add_updated_pks(self, dependents, pk_sets):
+        '''Adds the rows the update made the objects depend on.'''
+        values = get_update_values(self.query)
+        for (backend, lookup), pks in zip(dependents, pk_sets):
+            value = values.get(backend.get_dependent_field(lookup).name)
+            if value is not None and not is_expression(value):
+                pks.add(value)
+
+    def update_indexes(self, stale, pks):
+        '''Recomputes the stale index values of the objects with the given
+        pks, reading DBINDEXER_CHUNK_SIZE objects at a time. Objects of a
+        chunk with equal index values get written by a single update.'''
+        manager = self.query.model._base_manager.using(self.using)
+        fields = [backend.get_index(lookup) for backend, lookup in stale]
+        for chunk in chunked(pks, get_chunk_size()):
+            groups = {}
+            for obj in manager.filter(pk__in=chunk):
+                values = [backend.index_value(lookup, obj)
+                          for backend, lookup in stale]
+                key = tuple([hashable(value) for value in values])
+                groups.setdefault(key, (values, []))[1].append(obj.pk)
+            for values, group in groups.values():
+                # index names of conjunctions contain '__', so update by field
+                manager.filter(pk__in=group)._update([(field, None, value)
+                    for field, value in zip(fields, values)])
 
 class SQLDeleteCompiler(BaseCompiler):
-    pass
+    def execute_sql(self, *args, **kwargs):
+        self.convert_filters()
+        dependents = resolver.get_dependents(self.query)
+        pk_sets = dependents and self.get_dependent_pks(dependents) or None
+        result = None
+        for _ in self.delete_batches():
+            result = super(SQLDeleteCompiler, self).execute_sql(*args,
+                                                                **kwargs)
+        if dependents:
+            self.refresh_dependents(dependents, pk_sets)
+        resolver.notify_write(self.query, 'delete')
+        return result
 
-class SQLDateCompiler(BaseCompiler):
-    pass
+    def delete_batches(self):
+        '''
+        Splits the largest 'in' filter of the query, e.g. pks resolved by
+        in-memory JOINs, into DBINDEXER_CHUNK_SIZE values and yields once
+        for each batch. Only lists, tuples and sets get split, other values
+        like querysets are passed through.
+        '''
+
+        where = self.query.where
+        size = get_chunk_size()
+        index = None
+        if not where.negated and (where.connector == 'AND' or
+                                  len(where.children) == 1):
+            for position, child in enumerate(where.children):
+                if isinstance(child, tuple) and child[1] == 'in' and \
+                        isinstance(child[3], (list, tuple, set, frozenset)) and \
+                        len(child[3]) > size and (index is None or
+                        len(child[3]) > len(where.children[index][3])):
+                    index = position
+        if index is None:
+            yield
+            return
 
-class SQLDateTimeCompiler(BaseCompiler):
+        constraint, lookup_type, annotation, values = where.children[index]
+        try:
+            for chunk in chunked(list(values), size):
+                where.children[index] = (constraint, lookup_type, annotation,
+                                         chunk)
+                yield
+        finally:
+            where.children[index] = (constraint, lookup_type, annotation,
+                                     values)
+
+class SQLDateCompiler(SQLCompiler):
     pass
 
-class SQLAggregateCompiler(BaseCompiler):
+class SQLDateTimeCompiler(SQLCompiler):
     pass
+
+class SQLAggregateCompiler(SQLCompiler):
+    clone_query = False
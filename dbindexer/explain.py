@@ -0,0 +1,163 @@
+'''
+Reports how dbindexer rewrites a query. While a query gets explained the
+backends add what they did to the active Explanation of the thread.
+'''
+
+from django.utils.tree import Node
+from copy import copy
+import threading
+import time
+import types
+
+_local = threading.local()
+
+def current():
+    '''Returns the Explanation collecting rewrites in this thread or None.'''
+    return getattr(_local, 'explanation', None)
+
+def activate(explanation):
+    _local.explanation = explanation
+
+def deactivate():
+    _local.explanation = None
+
+def describe_value(value):
+    if isinstance(value, types.GeneratorType):
+        return '<lazy>'
+    if isinstance(value, (list, tuple, set, frozenset)) and len(value) > 10:
+        return '<%d values>' % len(value)
+    return repr(value)
+
+def describe_child(child):
+    constraint, lookup_type, _, value = child
+    if constraint.field is not None:
+        name = '%s.%s' % (constraint.field.model._meta.object_name,
+                          constraint.field.name)
+    else:
+        name = '%s.%s' % (constraint.alias, constraint.col)
+    return '%s__%s=%s' % (name, lookup_type, describe_value(value))
+
+def describe_filters(filters):
+    descriptions = []
+    for child in filters.children:
+        if isinstance(child, Node):
+            descriptions.extend(describe_filters(child))
+        elif isinstance(child, tuple):
+            descriptions.append(describe_child(child))
+    return descriptions
+
+def copy_constraints(filters):
+    '''Query.clone() shares constraints, which get changed by rewrites.'''
+    for index, child in enumerate(filters.children):
+        if isinstance(child, Node):
+            copy_constraints(child)
+        elif isinstance(child, tuple):
+            filters.children[index] = (copy(child[0]), ) + child[1:]
+
+class Explanation(object):
+    def __init__(self, query):
+        self.model = query.model
+        self.constraints = describe_filters(query.where)
+        self.rewrites = []
+        self.removed_joins = []
+        self.join_queries = []
+        self.residual_filters = []
+        self.orderings = []
+        self.filters = None
+        self.conversion_time = None
+        self.query_time = None
+        self.rows = None
+
+    def add_rewrite(self, backend, child, index_name, lookup_type, value,
+                    lookup=None):
+        self.rewrites.append({
+            'backend': backend.__class__.__name__,
+            'lookup': lookup is not None and lookup.__class__.__name__ or None,
+            'constraint': describe_child(child),
+            'index_name': index_name,
+            'lookup_type': lookup_type,
+            'value': describe_value(value),
+        })
+
+    def add_join_query(self, model, lookup, pks, seconds, cached=False):
+        self.join_queries.append({
+            'model': model._meta.object_name,
+            'lookup': dict([(name, describe_value(value))
+                            for name, value in lookup.items()]),
+            'pks': len(pks),
+            'seconds': seconds,
+            'cached': cached,
+        })
+
+    def format(self):
+        lines = ['Query on %s.%s' % (self.model._meta.app_label,
+                                     self.model._meta.object_name)]
+        lines.append('Filters:')
+        lines.extend(['  %s' % constraint for constraint in self.constraints])
+        if self.rewrites:
+            lines.append('Rewrites:')
+        for rewrite in self.rewrites:
+            lines.append('  %s by %s%s: %s__%s=%s' % (rewrite['constraint'],
+                rewrite['backend'], rewrite['lookup'] and
+                ' (%s)' % rewrite['lookup'] or '', rewrite['index_name'],
+                rewrite['lookup_type'], rewrite['value']))
+        if self.removed_joins:
+            lines.append('Removed JOINs: %s' % ', '.join(self.removed_joins))
+        if self.join_queries:
+            lines.append('In-memory JOIN queries:')
+        for join_query in self.join_queries:
+            lookup = ', '.join(['%s=%s' % item for item in
+                                sorted(join_query['lookup'].items())])
+            lines.append('  %s.filter(%s): %d pks, %.1f ms%s' % (
+                join_query['model'], lookup, join_query['pks'],
+                join_query['seconds'] * 1000,
+                join_query['cached'] and ' (cached)' or ''))
+        if self.residual_filters:
+            lines.append('Residual filters: %s' %
+                         ', '.join(self.residual_filters))
+        if self.orderings:
+            lines.append('Orderings: %s' % ', '.join(
+                ['%s -> %s' % item for item in self.orderings]))
+        lines.append('Converted filters:')
+        lines.extend(['  %s' % constraint for constraint in self.filters or ()])
+        lines.append('Conversion: %.1f ms' % (self.conversion_time * 1000))
+        if self.rows is not None:
+            lines.append('Query: %.1f ms, %d rows' % (self.query_time * 1000,
+                                                      self.rows))
+        return '\n'.join(lines)
+
+    __str__ = format
+
+def explain(queryset, live=False):
+    '''
+    Converts a copy of the query of queryset and returns the Explanation of
+    its rewrites. In-memory JOIN queries have to run to convert a query.
+    If live is True the converted query gets executed as well.
+    '''
+    from .resolver import resolver
+
+    query = queryset.query.clone()
+    copy_constraints(query.where)
+    compiler = query.get_compiler(queryset.db)
+    explanation = Explanation(query)
+    activate(explanation)
+    try:
+        started = time.time()
+        if hasattr(compiler, 'convert_filters'):
+            compiler.convert_filters()
+            # compilers convert a copy of the query
+            query = compiler.query
+        else:
+            resolver.convert_filters(query)
+        explanation.conversion_time = time.time() - started
+        explanation.filters = describe_filters(query.where)
+
+        if live:
+            started = time.time()
+            explanation.rows = 0
+            for _ in compiler.results_iter():
+                explanation.rows += 1
+            explanation.query_time = time.time() - started
+    finally:
+        deactivate()
+    return explanation
@@ -1,13 +1,49 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 from djangotoolbox.fields import ListField
 from copy import deepcopy
+from datetime import date
+from decimal import Decimal
 
+import math
 import re
+import struct
+import unicodedata
 regex = type(re.compile(''))
 
 class LookupDoesNotExist(Exception):
     pass
 
+class FieldPrototype(object):
+    '''
+    Immutable description of an index field. Fields can't be shared between
+    models, so lookups keep a prototype and build a new field from it, which
+    is much cheaper than deep-copying a field.
+    '''
+    __slots__ = ('field_class', 'args', 'kwargs')
+
+    def __init__(self, field_class, *args, **kwargs):
+        self.field_class = field_class
+        self.args = args
+        self.kwargs = kwargs
+
+    def build(self):
+        return self.field_class(*[build_field(arg) for arg in self.args],
+            **self.kwargs)
+
+def build_field(field):
+    '''Returns a new field for field, which can be a FieldPrototype or a
+    field instance.'''
+    if isinstance(field, FieldPrototype):
+        return field.build()
+    if isinstance(field, models.Field):
+        return deepcopy(field)
+    return field
+
+char_field = FieldPrototype(models.CharField, max_length=500, editable=False,
+                            null=True)
+
 class LookupBase(type):
     def __new__(cls, name, bases, attrs):
         new_cls = type.__new__(cls, name, bases, attrs)
@@ -18,13 +54,36 @@ class LookupBase(type):
 class ExtraFieldLookup(object):
     '''Default is to behave like an exact filter on an ExtraField.'''
     __metaclass__ = LookupBase
+    # there can be thousands of lookups, so subclasses have to define
+    # __slots__, too
+    __slots__ = ('model', 'field_name', 'lookup_def', 'new_lookup',
+                 'field_to_add', 'condition', 'version', 'index_key')
     lookup_types = 'exact'
+    # Lookups of a field with the same encoding store the same values, so
+    # with DBINDEXER_SHARE_ENCODINGS they share one index field named after
+    # the encoding. Encodings are named after the lookup type whose index
+    # field they use. Turning the setting on moves the other lookups to that
+    # field, which has to be filled in for existing rows, e.g. by resaving.
+    encoding = None
+    # True if index values sort like the values of the indexed field with the
+    # lookup's transformation applied, so they can be used for ordering
+    orderable = False
+    # True if convert_lookup returns a list of values which all have to be
+    # contained in the indexed ListField
+    matches_all_values = False
 
     def __init__(self, model=None, field_name=None, lookup_def=None,
-                 new_lookup='exact', field_to_add=models.CharField(
-                 max_length=500, editable=False, null=True)):
+                 new_lookup='exact', field_to_add=char_field):
         self.field_to_add = field_to_add
         self.new_lookup = new_lookup
+        # field values of the rows to index, see register_index
+        self.condition = None
+        # versions of an index get index fields of their own, see
+        # dbindexer.migration
+        self.version = None
+        # model, field name, index_type and condition, shared by all
+        # versions of an index
+        self.index_key = None
         self.contribute(model, field_name, lookup_def)
 
     def contribute(self, model, field_name, lookup_def):
@@ -32,9 +91,19 @@ class ExtraFieldLookup(object):
         self.field_name = field_name
         self.lookup_def = lookup_def
 
+    @property
+    def index_type(self):
+        '''Names the filters the index answers. Versions of an index share
+        it, even if their arguments differ.'''
+        return self.lookup_types[0]
+
     @property
     def index_name(self):
-        return 'idxf_%s_l_%s' % (self.field_name, self.lookup_types[0])
+        encoding = None
+        if getattr(settings, 'DBINDEXER_SHARE_ENCODINGS', False):
+            encoding = self.encoding
+        return 'idxf_%s_l_%s' % (self.field_name,
+                                 encoding or self.lookup_types[0])
 
     def convert_lookup(self, value, lookup_type):
         # TODO: can value be a list or tuple? (in case of in yes)
@@ -62,25 +131,40 @@ class ExtraFieldLookup(object):
         return self.model == model and lookup_type in self.lookup_types \
             and field_name == self.field_name
 
+    def matches_ordering(self, model, name):
+        '''Returns True if ordering model by name ('field__lookup_type')
+        can be done on the index values.'''
+        return self.orderable and self.model == model and \
+            name == '%s__%s' % (self.field_name, self.lookup_types[0])
+
     @classmethod
     def matches_lookup_def(cls, lookup_def):
         if lookup_def in cls.lookup_types:
             return True
         return False
 
+    def get_args(self):
+        '''Returns the constructor arguments changing the index values, see
+        dump_args.'''
+        return {}
+
     def get_field_to_add(self, field_to_index):
-        field_to_add = deepcopy(self.field_to_add)
+        field_to_add = build_field(self.field_to_add)
         if isinstance(field_to_index, ListField):
             field_to_add = ListField(field_to_add, editable=False, null=True)
         return field_to_add
 
 class DateLookup(ExtraFieldLookup):
+    __slots__ = ()
     # DateLookup is abstract so set lookup_types to None so it doesn't match
     lookup_types = None
+    orderable = True
+    field_prototype = FieldPrototype(models.IntegerField, editable=False,
+                                     null=True)
 
     def __init__(self, *args, **kwargs):
         defaults = {'new_lookup': 'exact',
-                    'field_to_add': models.IntegerField(editable=False, null=True)}
+                    'field_to_add': self.field_prototype}
         defaults.update(kwargs)
         ExtraFieldLookup.__init__(self, *args, **defaults)
 
@@ -88,36 +172,42 @@ class DateLookup(ExtraFieldLookup):
         return self.new_lookup, value
 
 class Day(DateLookup):
+    __slots__ = ()
     lookup_types = 'day'
 
     def _convert_value(self, value):
         return value.day
 
 class Month(DateLookup):
+    __slots__ = ()
     lookup_types = 'month'
 
     def _convert_value(self, value):
         return value.month
 
 class Year(DateLookup):
+    __slots__ = ()
     lookup_types = 'year'
 
     def _convert_value(self, value):
         return value.year
 
 class Weekday(DateLookup):
+    __slots__ = ()
     lookup_types = 'week_day'
 
     def _convert_value(self, value):
         return value.isoweekday()
 
 class Contains(ExtraFieldLookup):
+    __slots__ = ()
     lookup_types = 'contains'
+    field_prototype = FieldPrototype(ListField,
+        FieldPrototype(models.CharField, 500), editable=False, null=True)
 
     def __init__(self, *args, **kwargs):
         defaults = {'new_lookup': 'startswith',
-                    'field_to_add': ListField(models.CharField(500),
-                                              editable=False, null=True)
+                    'field_to_add': self.field_prototype
         }
         defaults.update(kwargs)
         ExtraFieldLookup.__init__(self, *args, **defaults)
@@ -125,7 +215,7 @@ class Contains(ExtraFieldLookup):
     def get_field_to_add(self, field_to_index):
         # always return a ListField of CharFields even in the case of
         # field_to_index being a ListField itself!
-        return deepcopy(self.field_to_add)
+        return build_field(self.field_to_add)
 
     def convert_value(self, value):
         new_value = []
@@ -146,7 +236,73 @@ class Contains(ExtraFieldLookup):
             result.extend([value[count:] for count in range(len(value))])
         return result
 
+class Search(ExtraFieldLookup):
+    '''
+    Inverted index of the words of a text. Words get lowercased, stripped
+    of accents and optionally stemmed, e.g. Search(stemmer=stem) with a
+    function mapping a word to its stem. A filter like
+    text__search='quick fox' matches texts containing all of its words.
+    '''
+    __slots__ = ('stemmer', )
+    lookup_types = 'search'
+    matches_all_values = True
+    field_prototype = FieldPrototype(ListField,
+        FieldPrototype(models.CharField, max_length=500), editable=False,
+        null=True)
+    word_re = re.compile(r'\w+', re.U)
+
+    def __init__(self, *args, **kwargs):
+        self.stemmer = kwargs.pop('stemmer', None)
+        defaults = {'new_lookup': 'exact',
+                    'field_to_add': self.field_prototype
+        }
+        defaults.update(kwargs)
+        ExtraFieldLookup.__init__(self, *args, **defaults)
+
+    def get_args(self):
+        return {'stemmer': self.stemmer}
+
+    def get_field_to_add(self, field_to_index):
+        # tokens of ListFields end up in a single list, too
+        return build_field(self.field_to_add)
+
+    def tokenize(self, value):
+        if not isinstance(value, unicode):
+            value = unicode(value)
+        value = u''.join([char for char in
+                          unicodedata.normalize('NFKD', value.lower())
+                          if not unicodedata.combining(char)])
+        tokens = []
+        for word in self.word_re.findall(value):
+            if self.stemmer is not None:
+                word = self.stemmer(word)
+            if word not in tokens:
+                tokens.append(word)
+        return tokens
+
+    def convert_value(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, (tuple, list)):
+            value = (value, )
+        tokens = []
+        for val in value:
+            if val is not None:
+                tokens.extend([token for token in self.tokenize(val)
+                               if token not in tokens])
+        return tokens
+
+    def convert_lookup(self, value, lookup_type):
+        tokens = self.convert_value(value)
+        if not tokens:
+            # there's nothing to search for, so nothing matches
+            return 'in', []
+        if len(tokens) == 1:
+            return self.new_lookup, tokens[0]
+        return self.new_lookup, tokens
+
 class Icontains(Contains):
+    __slots__ = ()
     lookup_types = 'icontains'
 
     def convert_value(self, value):
@@ -156,7 +312,10 @@ class Icontains(Contains):
         return self.new_lookup, value.lower()
 
 class Iexact(ExtraFieldLookup):
+    __slots__ = ()
     lookup_types = 'iexact'
+    encoding = 'iexact'
+    orderable = True
 
     def _convert_lookup(self, value, lookup_type):
         return self.new_lookup, value.lower()
@@ -165,7 +324,11 @@ class Iexact(ExtraFieldLookup):
         return value.lower()
 
 class Istartswith(ExtraFieldLookup):
+    __slots__ = ()
     lookup_types = 'istartswith'
+    # stores value.lower() like Iexact
+    encoding = 'iexact'
+    orderable = True
 
     def __init__(self, *args, **kwargs):
         defaults = {'new_lookup': 'startswith'}
@@ -179,6 +342,7 @@ class Istartswith(ExtraFieldLookup):
         return value.lower()
 
 class Endswith(ExtraFieldLookup):
+    __slots__ = ()
     lookup_types = 'endswith'
 
     def __init__(self, *args, **kwargs):
@@ -193,6 +357,7 @@ class Endswith(ExtraFieldLookup):
         return value[::-1]
 
 class Iendswith(Endswith):
+    __slots__ = ()
     lookup_types = 'iendswith'
 
     def _convert_lookup(self, value, lookup_type):
@@ -202,11 +367,13 @@ class Iendswith(Endswith):
         return value[::-1].lower()
 
 class RegexLookup(ExtraFieldLookup):
+    __slots__ = ()
     lookup_types = ('regex', 'iregex')
+    field_prototype = FieldPrototype(models.NullBooleanField, editable=False,
+                                     null=True)
 
     def __init__(self, *args, **kwargs):
-        defaults = {'field_to_add': models.NullBooleanField(editable=False,
-                                                            null=True)
+        defaults = {'field_to_add': self.field_prototype
         }
         defaults.update(kwargs)
         ExtraFieldLookup.__init__(self, *args, **defaults)
@@ -217,6 +384,10 @@ class RegexLookup(ExtraFieldLookup):
             self.lookup_def = re.compile(lookup_def.pattern, re.S | re.U |
                                          (lookup_def.flags & re.I))
 
+    @property
+    def index_type(self):
+        return '%s/%d' % (self.lookup_def.pattern, self.lookup_def.flags)
+
     @property
     def index_name(self):
         return 'idxf_%s_l_%s' % (self.field_name,
@@ -248,12 +419,19 @@ class StandardLookup(ExtraFieldLookup):
     ''' Creates a copy of the field_to_index in order to allow querying for
         standard lookup_types on a JOINed property. '''
     # TODO: database backend can specify standardLookups
+    __slots__ = ()
     lookup_types = ('exact', 'gt', 'gte', 'lt', 'lte', 'in', 'range', 'isnull')
+    orderable = True
 
     @property
     def index_name(self):
         return 'idxf_%s_l_%s' % (self.field_name, 'standard')
 
+    def matches_ordering(self, model, name):
+        # a copy of a JOINed field orders like the field itself
+        return self.model == model and name in (self.field_name,
+            '%s__exact' % self.field_name)
+
     def convert_lookup(self, value, lookup_type):
         return lookup_type, value
 
@@ -264,3 +442,620 @@ class StandardLookup(ExtraFieldLookup):
             field_to_add.auto_now_add = field_to_add.auto_now = False
         field_to_add.name = self.index_name
         return field_to_add
+
+class ReverseLookup(ExtraFieldLookup):
+    '''
+    Base class of lookups storing a value computed from the rows of a
+    reverse relation on the parent model. field_name is a tuple of the
+    relation's accessor name and optionally a field of its rows, e.g.
+    ('post_set', 'published') for 'post_set__published'. Subclasses
+    implement convert_value(values), which returns the index value of a
+    parent whose related rows have the given values of that field, and
+    merge(value, values), which returns the index value of a parent storing
+    value after rows with the given values got added.
+    '''
+    __slots__ = ()
+    # ReverseLookup is abstract so set lookup_types to None so it doesn't match
+    lookup_types = None
+
+    def contribute(self, model, field_name, lookup_def):
+        if isinstance(field_name, basestring):
+            field_name = tuple(field_name.split('__'))
+        ExtraFieldLookup.contribute(self, model, field_name, lookup_def)
+
+    @property
+    def relation_name(self):
+        return self.field_name[0]
+
+    def merge(self, value, values):
+        raise NotImplementedError()
+
+    @property
+    def target_name(self):
+        return len(self.field_name) > 1 and self.field_name[1] or None
+
+class Aggregate(ReverseLookup):
+    '''
+    Materializes an aggregate of a reverse relation on the parent model, e.g.
+    {'post_set': 'count'} or {'post_set__published': 'max'}. Queries filter
+    and order by its index field, e.g. idxf_post_set_l_count__gt=10.
+    '''
+    __slots__ = ('function', )
+    lookup_types = ('count', 'max', 'min', 'sum')
+
+    def __init__(self, *args, **kwargs):
+        self.function = kwargs.pop('function', 'count')
+        ReverseLookup.__init__(self, *args, **kwargs)
+
+    def contribute(self, model, field_name, lookup_def):
+        ReverseLookup.contribute(self, model, field_name, lookup_def)
+        if lookup_def in self.lookup_types:
+            self.function = lookup_def
+
+    def get_args(self):
+        return {'function': self.function}
+
+    @property
+    def index_type(self):
+        return self.function
+
+    @property
+    def index_name(self):
+        return 'idxf_%s_l_%s' % ('_'.join(self.field_name), self.function)
+
+    def get_field_to_add(self, field_to_index):
+        if self.function == 'count':
+            return models.IntegerField(default=0, editable=False)
+        field_to_add = deepcopy(field_to_index)
+        field_to_add.primary_key = field_to_add._unique = False
+        field_to_add.null = True
+        field_to_add.editable = False
+        if isinstance(field_to_add, (models.DateTimeField,
+                                    models.DateField, models.TimeField)):
+            field_to_add.auto_now_add = field_to_add.auto_now = False
+        if self.function == 'sum':
+            field_to_add.default = 0
+        field_to_add.name = self.index_name
+        return field_to_add
+
+    def convert_value(self, values):
+        if self.function == 'count':
+            return len(values)
+        values = [value for value in values if value is not None]
+        if self.function == 'sum':
+            return sum(values)
+        if not values:
+            return None
+        if self.function == 'max':
+            return max(values)
+        return min(values)
+
+    def merge(self, value, values):
+        if self.function == 'count':
+            return (value or 0) + len(values)
+        if self.function == 'sum':
+            return (value or 0) + self.convert_value(values)
+        if value is not None:
+            values = list(values) + [value]
+        return self.convert_value(values)
+
+class ReverseJOIN(ReverseLookup):
+    '''
+    Stores the values of a field of the rows of a reverse relation, converted
+    by another lookup, in a ListField on the parent model. Created by
+    ReverseJOINResolver for lookups registered on reverse relations, e.g.
+    {'idx_set__name': 'iexact'}.
+    '''
+    __slots__ = ('lookup', )
+
+    def __init__(self, *args, **kwargs):
+        self.lookup = kwargs.pop('lookup', None)
+        ReverseLookup.__init__(self, *args, **kwargs)
+
+    def contribute(self, model, field_name, lookup_def):
+        ReverseLookup.contribute(self, model, field_name, lookup_def)
+        if field_name is None:
+            return
+        if self.lookup is None and lookup_def is not None:
+            from .api import create_lookup
+            self.lookup = create_lookup(lookup_def)
+        if self.lookup is not None:
+            # the wrapped lookup only converts values of the related rows
+            self.lookup.contribute(None, self.target_name, lookup_def)
+
+    def get_args(self):
+        return {'lookup': self.lookup}
+
+    @property
+    def index_type(self):
+        return self.lookup.index_type
+
+    @property
+    def index_name(self):
+        # index names mustn't contain '__', update() and values_list() would
+        # take them for lookups
+        return 'idxf_%s_r_%s' % (self.relation_name,
+                                 self.lookup.index_name[len('idxf_'):])
+
+    @property
+    def matches_all_values(self):
+        return self.lookup.matches_all_values
+
+    def matches_filter(self, model, field_name, lookup_type, value):
+        return self.model == model and \
+            field_name == '__'.join(self.field_name) and \
+            self.lookup.matches_filter(self.lookup.model, self.target_name,
+                                       lookup_type, value)
+
+    def convert_lookup(self, value, lookup_type):
+        return self.lookup.convert_lookup(value, lookup_type)
+
+    def get_field_to_add(self, field_to_index):
+        field_to_add = self.lookup.get_field_to_add(field_to_index)
+        if isinstance(field_to_add, ListField):
+            return field_to_add
+        return ListField(field_to_add, editable=False, null=True)
+
+    def convert_value(self, values):
+        converted = []
+        seen = set()
+        for value in values:
+            value = self.lookup.convert_value(value)
+            if not isinstance(value, list):
+                value = [value]
+            for item in value:
+                if item is not None and item not in seen:
+                    seen.add(item)
+                    converted.append(item)
+        return converted
+
+    def merge(self, value, values):
+        merged = list(value or ())
+        merged.extend([item for item in self.convert_value(values)
+                       if item not in merged])
+        return merged
+
+def dump_arg(value):
+    '''Returns a JSON compatible description of a lookup argument. Callables
+    are described by their import path.'''
+    if isinstance(value, ExtraFieldLookup):
+        return {'lookup': '%s.%s' % (value.__class__.__module__,
+                                     value.__class__.__name__),
+                'args': dump_args(value)}
+    if isinstance(value, (list, tuple)):
+        return [dump_arg(item) for item in value]
+    if callable(value):
+        return {'callable': '%s.%s' % (value.__module__, value.__name__)}
+    return value
+
+def dump_args(lookup):
+    '''Describes the arguments of lookup for registration keys and
+    manifests.'''
+    return dict([(name, dump_arg(value))
+                 for name, value in lookup.get_args().items()])
+
+def encode_key_part(value, complete=True):
+    '''
+    Encodes value for a key of several values. Keys sort like the tuples of
+    their values as long as each position always has values of one type.
+    Encoded strings which aren't complete can be used as a prefix.
+    '''
+    if value is None:
+        return 'n'
+    if isinstance(value, (int, long)):
+        return 'i%016x' % (value + (1 << 63))
+    if isinstance(value, (float, Decimal)):
+        # flip the sign bit of positive values and all bits of negative ones
+        bits = struct.unpack('>Q', struct.pack('>d', float(value)))[0]
+        if bits >> 63:
+            bits ^= (1 << 64) - 1
+        else:
+            bits |= 1 << 63
+        return 'f%016x' % bits
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = unicode(value).encode('utf-8')
+    # hex digits sort like the bytes and '.' sorts before all of them
+    return 's%s%s' % (value.encode('hex'), complete and '.' or '')
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+def geohash_bits(precision):
+    '''Returns the number of latitude and longitude bits of geohashes with
+    precision characters.'''
+    bits = 5 * precision
+    return bits // 2, bits - bits // 2
+
+def geohash_cell(value, minimum, maximum, bits):
+    '''Returns the cell containing value if [minimum, maximum] gets split
+    into 2 ** bits cells.'''
+    cells = 1 << bits
+    cell = int((float(value) - minimum) / (maximum - minimum) * cells)
+    return min(max(cell, 0), cells - 1)
+
+def geohash_from_cells(lat_cell, lng_cell, precision):
+    lat_bits, lng_bits = geohash_bits(precision)
+    code = 0
+    for bit in range(5 * precision):
+        # bits alternate between longitude and latitude, starting with the
+        # most significant longitude bit
+        if bit % 2 == 0:
+            lng_bits -= 1
+            code = code << 1 | (lng_cell >> lng_bits) & 1
+        else:
+            lat_bits -= 1
+            code = code << 1 | (lat_cell >> lat_bits) & 1
+    chars = []
+    for _ in range(precision):
+        chars.append(GEOHASH_BASE32[code & 31])
+        code >>= 5
+    return ''.join(reversed(chars))
+
+def geohash(lat, lng, precision):
+    '''Returns the geohash of a point with precision characters.'''
+    lat_bits, lng_bits = geohash_bits(precision)
+    return geohash_from_cells(geohash_cell(lat, -90.0, 90.0, lat_bits),
+                              geohash_cell(lng, -180.0, 180.0, lng_bits),
+                              precision)
+
+def distance(lat1, lng1, lat2, lng2):
+    '''Returns the great-circle distance between two points in meters.'''
+    lat1, lng1, lat2, lng2 = [math.radians(float(value))
+                              for value in (lat1, lng1, lat2, lng2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * \
+        math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+class ConjunctionLookup(ExtraFieldLookup):
+    '''
+    Base class of lookups indexing several fields of a model in a single
+    field. field_name is a tuple. ConjunctionResolver maintains them and
+    converts conjunctions of filters on their fields by calling
+    convert_filters(filters) with the (field_name, lookup_type, value)
+    filters of the conjunction. Subclasses return the positions of the
+    combined filters, the new lookup type and the new value or None if
+    filters can't be combined.
+    '''
+    __slots__ = ()
+    # ConjunctionLookup is abstract so set lookup_types to None so it doesn't match
+    lookup_types = None
+    # True if the converted filter only narrows down the results, so the
+    # combined filters still have to be applied to them
+    residual = False
+
+    @property
+    def field_names(self):
+        return self.field_name
+
+class Composite(ConjunctionLookup):
+    '''
+    Indexes several fields, optionally transformed by another lookup, as one
+    key, e.g. ('tenant', 'name__iexact', 'published__year'): 'composite'.
+    Filters on all of these fields become an exact filter on the key,
+    filters on leading fields a startswith filter.
+    '''
+    __slots__ = ('parts', )
+    lookup_types = 'composite'
+
+    def contribute(self, model, field_name, lookup_def):
+        ConjunctionLookup.contribute(self, model, field_name, lookup_def)
+        self.parts = []
+        if field_name is not None:
+            self.parts = [self.get_part(part) for part in field_name]
+
+    def get_part(self, part):
+        '''Returns the field name and the transforming lookup of part.'''
+        from .api import create_lookup
+        name, _, lookup_type = part.rpartition('__')
+        if not name:
+            return part, None
+        if lookup_type == 'exact':
+            return name, None
+        try:
+            transform = create_lookup(lookup_type)
+        except LookupDoesNotExist:
+            return part, None
+        if isinstance(transform, (ConjunctionLookup, RegexLookup,
+                                  StandardLookup)) or \
+                isinstance(build_field(transform.field_to_add), ListField):
+            raise ImproperlyConfigured('Composite can\'t index %s.' % part)
+        transform.contribute(self.model, name, lookup_type)
+        return name, transform
+
+    @property
+    def field_names(self):
+        return [name for name, _ in self.parts]
+
+    @property
+    def index_name(self):
+        return 'idxf_%s_l_composite' % '__'.join(self.field_name)
+
+    def get_field_to_add(self, field_to_index):
+        field_to_add = ConjunctionLookup.get_field_to_add(self, field_to_index)
+        lengths = [self.get_part_length(position)
+                   for position in range(len(self.parts))]
+        if None in lengths or sum(lengths) > field_to_add.max_length:
+            raise ImproperlyConfigured('Keys of %s.%s can be longer than %d '
+                'characters, reduce the max_length of its fields.' % (
+                self.model._meta.object_name, self.index_name,
+                field_to_add.max_length))
+        return field_to_add
+
+    def get_part_length(self, position):
+        '''Returns the maximal length of an encoded key part, counting a
+        byte per character of strings, or None if it's unbounded.'''
+        name, transform = self.parts[position]
+        field = self.model._meta.get_field(name)
+        if field.rel is not None:
+            field = field.rel.get_related_field()
+        if isinstance(transform, DateLookup) or isinstance(field, (
+                models.AutoField, models.IntegerField, models.FloatField,
+                models.DecimalField, models.BooleanField,
+                models.NullBooleanField)):
+            return 17
+        if isinstance(field, models.DateTimeField):
+            length = len('2000-01-01T00:00:00.000000+00:00')
+        elif isinstance(field, models.DateField):
+            length = len('2000-01-01')
+        elif isinstance(field, models.TimeField):
+            length = len('00:00:00.000000')
+        else:
+            length = field.max_length
+        if length is None:
+            return None
+        # hex digits, the type prefix and the terminator
+        return 2 * length + 2
+
+    def convert_part(self, position, value, lookup_type=None):
+        name, transform = self.parts[position]
+        if transform is None:
+            return 'exact', \
+                self.model._meta.get_field(name).get_prep_value(value)
+        if lookup_type is None:
+            return 'exact', transform.convert_value(value)
+        return transform.convert_lookup(value, lookup_type)
+
+    def convert_value(self, values):
+        return ''.join([encode_key_part(self.convert_part(position, value)[1])
+                        for position, value in enumerate(values)])
+
+    def find_filter(self, filters, position, used):
+        name, transform = self.parts[position]
+        lookup_types = transform and transform.lookup_types or ('exact', )
+        for index, (field_name, lookup_type, _) in enumerate(filters):
+            if field_name == name and lookup_type in lookup_types and \
+                    index not in used:
+                return index
+        return None
+
+    def convert_filters(self, filters):
+        positions = []
+        key = []
+        new_lookup_type = 'exact'
+        for position in range(len(self.parts)):
+            index = self.find_filter(filters, position, positions)
+            if index is None:
+                break
+            _, lookup_type, value = filters[index]
+            new_lookup_type, value = self.convert_part(position, value,
+                                                       lookup_type)
+            positions.append(index)
+            key.append(encode_key_part(value, new_lookup_type == 'exact'))
+            # transformed prefixes like istartswith end the key
+            if new_lookup_type != 'exact':
+                break
+
+        if len(positions) < 2:
+            return None
+        if len(positions) < len(self.parts):
+            new_lookup_type = 'startswith'
+        return positions, new_lookup_type, ''.join(key)
+
+class GeoHash(ConjunctionLookup):
+    '''
+    Indexes a latitude and a longitude field as the geohashes of their point
+    with 1 up to precision characters, e.g. ('lat', 'lng'): 'geohash'.
+    Bounding-box filters on these fields become an 'in' filter on the cells
+    covering the box, using the finest precision needing at most max_cells
+    cells. The exact bounds get checked on the results.
+    '''
+    __slots__ = ('precision', 'max_cells')
+    lookup_types = 'geohash'
+    residual = True
+    bound_lookups = ('exact', 'gt', 'gte', 'lt', 'lte', 'range')
+
+    def __init__(self, *args, **kwargs):
+        self.precision = kwargs.pop('precision', 8)
+        self.max_cells = kwargs.pop('max_cells', 16)
+        defaults = {'field_to_add': FieldPrototype(ListField,
+            FieldPrototype(models.CharField, max_length=self.precision),
+            editable=False, null=True)
+        }
+        defaults.update(kwargs)
+        ConjunctionLookup.__init__(self, *args, **defaults)
+
+    def get_args(self):
+        return {'precision': self.precision, 'max_cells': self.max_cells}
+
+    @property
+    def index_name(self):
+        return 'idxf_%s_l_geohash' % '__'.join(self.field_name)
+
+    def convert_value(self, values):
+        lat, lng = values
+        if lat is None or lng is None:
+            return None
+        code = geohash(lat, lng, self.precision)
+        return [code[:length] for length in range(1, self.precision + 1)]
+
+    def get_bounds(self, lookup_type, value):
+        if lookup_type == 'range':
+            return value
+        if lookup_type == 'exact':
+            return value, value
+        if lookup_type in ('gt', 'gte'):
+            return value, None
+        return None, value
+
+    def covering_cells(self, bounds):
+        '''Returns the geohashes of the cells covering the box given by
+        [[min_lat, max_lat], [min_lng, max_lng]] or None if it's too large.'''
+        (min_lat, max_lat), (min_lng, max_lng) = bounds
+        if min_lat > max_lat or min_lng > max_lng:
+            return []
+        for precision in range(self.precision, 0, -1):
+            lat_bits, lng_bits = geohash_bits(precision)
+            lat_cells = range(geohash_cell(min_lat, -90.0, 90.0, lat_bits),
+                              geohash_cell(max_lat, -90.0, 90.0, lat_bits) + 1)
+            lng_cells = range(geohash_cell(min_lng, -180.0, 180.0, lng_bits),
+                              geohash_cell(max_lng, -180.0, 180.0, lng_bits) + 1)
+            if len(lat_cells) * len(lng_cells) <= self.max_cells:
+                return [geohash_from_cells(lat_cell, lng_cell, precision)
+                        for lat_cell in lat_cells for lng_cell in lng_cells]
+        return None
+
+    def convert_filters(self, filters):
+        bounds = [[-90.0, 90.0], [-180.0, 180.0]]
+        positions = []
+        for index, (field_name, lookup_type, value) in enumerate(filters):
+            if field_name not in self.field_name or \
+                    lookup_type not in self.bound_lookups:
+                continue
+            axis = list(self.field_name).index(field_name)
+            low, high = self.get_bounds(lookup_type, value)
+            if low is not None:
+                bounds[axis][0] = max(bounds[axis][0], float(low))
+            if high is not None:
+                bounds[axis][1] = min(bounds[axis][1], float(high))
+            positions.append(index)
+
+        if not positions:
+            return None
+        cells = self.covering_cells(bounds)
+        if cells is None:
+            return None
+        return positions, 'in', cells
+
+class Bucket(ConjunctionLookup):
+    '''
+    Indexes a date, datetime or number field as the ids of the buckets
+    containing its value at several levels, e.g. {'published': 'bucket'}.
+    Datetimes get hour, day, month and year buckets, dates day, month and
+    year buckets and numbers buckets of 2 ** level values for each of
+    number_levels. Range filters bounded on both sides become an 'in' filter
+    on the covering buckets of the finest level needing at most max_buckets
+    buckets. The exact bounds get checked on the results.
+    '''
+    __slots__ = ('levels', 'max_buckets')
+    lookup_types = 'bucket'
+    residual = True
+    range_lookups = ('gt', 'gte', 'lt', 'lte', 'range')
+    datetime_levels = ('hour', 'day', 'month', 'year')
+    date_levels = ('day', 'month', 'year')
+    number_levels = (0, 4, 8, 12, 16, 20, 24)
+
+    def __init__(self, *args, **kwargs):
+        # levels default to the ones of the indexed field's type
+        self.levels = kwargs.pop('levels', None)
+        self.max_buckets = kwargs.pop('max_buckets', 32)
+        defaults = {'field_to_add': FieldPrototype(ListField,
+            FieldPrototype(models.CharField, max_length=32), editable=False,
+            null=True)
+        }
+        defaults.update(kwargs)
+        ConjunctionLookup.__init__(self, *args, **defaults)
+
+    def contribute(self, model, field_name, lookup_def):
+        if isinstance(field_name, basestring):
+            field_name = (field_name, )
+        ConjunctionLookup.contribute(self, model, field_name, lookup_def)
+        if model is not None and self.levels is None:
+            field = model._meta.get_field(field_name[0])
+            if isinstance(field, models.DateTimeField):
+                self.levels = self.datetime_levels
+            elif isinstance(field, models.DateField):
+                self.levels = self.date_levels
+            else:
+                self.levels = self.number_levels
+
+    def get_args(self):
+        return {'levels': self.levels, 'max_buckets': self.max_buckets}
+
+    @property
+    def index_name(self):
+        return 'idxf_%s_l_bucket' % self.field_name[0]
+
+    def get_bucket(self, value, level):
+        '''Returns the number of the bucket containing value.'''
+        if isinstance(level, (int, long)):
+            if isinstance(value, (int, long)):
+                return value >> level
+            return int(math.floor(float(value) / (1 << level)))
+        if getattr(value, 'tzinfo', None) is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        if level == 'year':
+            return value.year
+        if level == 'month':
+            return value.year * 12 + value.month - 1
+        if level == 'day':
+            return value.toordinal()
+        return value.toordinal() * 24 + getattr(value, 'hour', 0)
+
+    def bucket_id(self, bucket, level):
+        if isinstance(level, (int, long)):
+            return '%d:%d' % (level, bucket)
+        if level == 'year':
+            return '%04d' % bucket
+        if level == 'month':
+            return '%04d-%02d' % (bucket // 12, bucket % 12 + 1)
+        hour = None
+        if level == 'hour':
+            bucket, hour = divmod(bucket, 24)
+        day = date.fromordinal(bucket)
+        bucket_id = '%04d-%02d-%02d' % (day.year, day.month, day.day)
+        if hour is not None:
+            bucket_id += 'T%02d' % hour
+        return bucket_id
+
+    def convert_value(self, values):
+        value = values[0]
+        if value is None:
+            return None
+        return [self.bucket_id(self.get_bucket(value, level), level)
+                for level in self.levels]
+
+    def convert_filters(self, filters):
+        low = high = None
+        positions = []
+        for index, (field_name, lookup_type, value) in enumerate(filters):
+            if field_name != self.field_name[0] or \
+                    lookup_type not in self.range_lookups:
+                continue
+            if lookup_type == 'range':
+                bounds = value
+            elif lookup_type in ('gt', 'gte'):
+                bounds = value, None
+            else:
+                bounds = None, value
+            if bounds[0] is not None and (low is None or bounds[0] > low):
+                low = bounds[0]
+            if bounds[1] is not None and (high is None or bounds[1] < high):
+                high = bounds[1]
+            positions.append(index)
+
+        if low is None or high is None:
+            return None
+        if low > high:
+            return positions, 'in', []
+        for level in self.levels:
+            first = self.get_bucket(low, level)
+            last = self.get_bucket(high, level)
+            if last - first < self.max_buckets:
+                return positions, 'in', [self.bucket_id(bucket, level)
+                                         for bucket in range(first, last + 1)]
+        return None
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from optparse import make_option
+from dbindexer import load_indexes
+from dbindexer.explain import explain
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName> [field__lookup=value ...]'
+    help = ('Shows how dbindexer rewrites a query filtering the given model. '
+            'In-memory JOIN queries run in any case, --live executes the '
+            'converted query, too.')
+    option_list = BaseCommand.option_list + (
+        make_option('--live', action='store_true', dest='live',
+                    default=False, help='Execute and time the converted query.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('No model given.')
+        model = get_model(*args[0].split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model %s.' % args[0])
+
+        filters = {}
+        for arg in args[1:]:
+            if '=' not in arg:
+                raise CommandError('Filters have to look like '
+                                   'field__lookup=value.')
+            name, value = arg.split('=', 1)
+            filters[str(name)] = value
+
+        load_indexes()
+        explanation = explain(model._default_manager.filter(**filters),
+                              live=options['live'])
+        self.stdout.write(explanation.format() + '\n')
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from dbindexer import load_indexes
+from dbindexer.manifest import write_manifest
+from dbindexer.resolver import resolver
+
+class Command(BaseCommand):
+    args = '[manifest file]'
+    help = ('Writes the resolved index registry to a manifest file which is '
+            'loaded instead of creating the indexes at startup. Defaults to '
+            'the DBINDEXER_MANIFEST setting.')
+
+    def handle(self, *args, **options):
+        if args:
+            path = args[0]
+        else:
+            path = getattr(settings, 'DBINDEXER_MANIFEST', None)
+        if not path:
+            raise CommandError('No manifest file given.')
+
+        load_indexes()
+        # always build the registry from the register_index calls
+        resolver.materialize(use_manifest=False)
+        write_manifest(path)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from dbindexer import load_indexes
+from dbindexer import migration
+from dbindexer.models import IndexMigration
+
+class Command(BaseCommand):
+    args = '[index key ...]'
+    help = ('Backfills the index fields of versioned indexes and switches '
+            'queries to them, see dbindexer.migration. Defaults to all '
+            'versioned indexes.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None, help='Rows written per batch.'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep between batches.'),
+        make_option('--max-passes', type='int', dest='max_passes',
+                    default=5, help='Passes over all rows before giving up '
+                    'on rows changing during the backfill.'),
+        make_option('--finish', action='store_true', dest='finish',
+                    default=False, help='Stop writing the replaced versions '
+                    'of migrated indexes.'),
+        make_option('--status', action='store_true', dest='status',
+                    default=False, help='Only show the migration states.'),
+    )
+
+    def handle(self, *args, **options):
+        load_indexes()
+        migrations = migration.get_migrations()
+        if args:
+            keys = [key for _, _, key in migrations]
+            for key in args:
+                if key not in keys:
+                    raise CommandError('Unknown index %s.' % key)
+            migrations = [item for item in migrations if item[2] in args]
+
+        states = dict([(item.key, item) for item in
+                       IndexMigration.objects.filter(
+                           key__in=[key for _, _, key in migrations])])
+        for backend, lookup, key in migrations:
+            if options['status']:
+                self.report(states.get(key) or IndexMigration(key=key))
+            elif options['finish']:
+                if not migration.finish(key):
+                    self.stdout.write('%s: reads not switched to it\n' % key)
+            else:
+                self.report(migration.backfill(backend, lookup,
+                    batch_size=options['batch_size'], sleep=options['sleep'],
+                    report=self.report, max_passes=options['max_passes']))
+
+    def report(self, item):
+        self.stdout.write('%s: %s, pass %d, %d/%d rows (%.0f%%), '
+                          '%.1f rows/s\n' % (
+            item.key, item.state, item.passes + 1, item.rows, item.total,
+            item.progress() * 100, item.rows and item.throughput() or 0.0))
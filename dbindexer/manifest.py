@@ -0,0 +1,239 @@
+'''
+Precompiled index registry. write_manifest() serializes the resolved index
+state of all backends, load_manifest() rebuilds it without creating lookups
+from their definitions, probing for existing fields or walking model chains.
+Lookups are recreated from their class, their arguments (see
+ExtraFieldLookup.get_args) and their lookup definition. Arguments which
+can't be imported, e.g. lambdas, can't be stored in a manifest.
+'''
+
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.importlib import import_module
+from .api import registration_keys
+from .lookups import regex, dump_args
+from .resolver import resolver
+import hashlib
+import json
+import re
+
+MANIFEST_VERSION = 6
+
+class ManifestMismatch(Exception):
+    pass
+
+def class_path(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+def import_path(path):
+    module_name, attr_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), attr_name)
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def model_from_label(label):
+    model = get_model(*label.split('.', 1))
+    if model is None:
+        raise ManifestMismatch('Unknown model %s.' % label)
+    return model
+
+def model_fingerprint(model):
+    fields = [(f.name, f.column, class_path(f.__class__))
+              for f in model._meta.local_fields
+              if not f.name.startswith('idxf_')]
+    return hashlib.md5(repr(sorted(fields))).hexdigest()
+
+def dump_lookup_def(lookup_def):
+    if isinstance(lookup_def, regex):
+        return {'pattern': lookup_def.pattern, 'flags': lookup_def.flags}
+    return lookup_def
+
+def load_lookup_def(lookup_def):
+    if isinstance(lookup_def, dict):
+        return re.compile(lookup_def['pattern'], lookup_def['flags'])
+    if isinstance(lookup_def, unicode):
+        return str(lookup_def)
+    return lookup_def
+
+def load_arg(value):
+    if isinstance(value, dict):
+        if 'callable' in value:
+            return import_path(value['callable'])
+        return import_path(value['lookup'])(**load_args(value['args']))
+    if isinstance(value, list):
+        return tuple([load_arg(item) for item in value])
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+def load_args(args):
+    return dict([(str(name), load_arg(value)) for name, value in args.items()])
+
+def dump_lookup_args(lookup):
+    args = dump_args(lookup)
+    try:
+        load_args(args)
+    except (ImportError, AttributeError):
+        raise ValueError('The arguments of %s.%s can\'t be stored in a '
+            'manifest.' % (lookup.model._meta.object_name, lookup.index_name))
+    return args
+
+def load_field_name(field_name):
+    if isinstance(field_name, list):
+        return tuple([str(name) for name in field_name])
+    return str(field_name)
+
+def load_condition(condition):
+    if condition is None:
+        return None
+    return dict([(str(name), value) for name, value in condition.items()])
+
+def get_chain_models(model, field_name):
+    '''Returns all models the column names of a field chain depend on.'''
+    models = [model]
+    if isinstance(field_name, basestring):
+        for name in field_name.split('__')[:-1]:
+            try:
+                model = model._meta.get_field(name).rel.to
+            except Exception:
+                break
+            models.append(model)
+    return models
+
+def get_backends():
+    '''Returns the backends of the resolver including the backends they
+    consist of.'''
+    return resolver.get_all_backends()
+
+def write_manifest(path):
+    models = {}
+    for model, field_name, _ in resolver.registrations:
+        for chain_model in get_chain_models(model, field_name):
+            models[model_label(chain_model)] = model_fingerprint(chain_model)
+
+    backends = []
+    for backend in get_backends():
+        indexes = []
+        for lookup, index_field in backend.index_map.items():
+            target_model, target_name = backend.get_index_target(lookup)
+            for model in (lookup.model, target_model):
+                models[model_label(model)] = model_fingerprint(model)
+            indexes.append({
+                'model': model_label(lookup.model),
+                'field_name': lookup.field_name,
+                'lookup': class_path(lookup.__class__),
+                'args': dump_lookup_args(lookup),
+                'lookup_def': dump_lookup_def(lookup.lookup_def),
+                'index_name': backend.index_name(lookup),
+                'index_field': class_path(index_field.__class__),
+                'target': [model_label(target_model), target_name],
+                'condition': lookup.condition,
+                'version': lookup.version,
+                'index_key': lookup.index_key,
+            })
+        backends.append({
+            'backend': class_path(backend.__class__),
+            'indexes': indexes,
+            'column_to_name': backend.column_to_name,
+        })
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'registrations': sorted([key for _, _, key in resolver.registrations]),
+        'models': models,
+        'backends': backends,
+    }
+    manifest_file = open(path, 'w')
+    try:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    finally:
+        manifest_file.close()
+
+def read_manifest(manifest):
+    '''
+    Validates manifest against the loaded backends, the deferred
+    registrations and the models' fields. Returns the registrations, the
+    indexes to install and the column maps of all backends.
+    '''
+
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ManifestMismatch('Unsupported manifest version.')
+
+    backends = get_backends()
+    if [class_path(backend.__class__) for backend in backends] != \
+            [data['backend'] for data in manifest['backends']]:
+        raise ManifestMismatch('DBINDEXER_BACKENDS changed.')
+
+    registrations = []
+    for model, mapping, condition, version in resolver.deferred:
+        registrations.extend(registration_keys(model, mapping, condition,
+                                               version))
+    if sorted([key for _, _, key in registrations]) != \
+            manifest['registrations']:
+        raise ManifestMismatch('Index registrations changed.')
+
+    for label, fingerprint in manifest['models'].items():
+        if model_fingerprint(model_from_label(label)) != fingerprint:
+            raise ManifestMismatch('Fields of %s changed.' % label)
+
+    installs = []
+    for backend, data in zip(backends, manifest['backends']):
+        for index in data['indexes']:
+            lookup = import_path(index['lookup'])(
+                **load_args(index['args']))
+            lookup.contribute(model_from_label(index['model']),
+                              load_field_name(index['field_name']),
+                              load_lookup_def(index['lookup_def']))
+            lookup.condition = load_condition(index['condition'])
+            lookup.version = index['version']
+            lookup.index_key = index['index_key'] and str(index['index_key'])
+            if backend.index_name(lookup) != index['index_name']:
+                raise ManifestMismatch('Index name of %s changed.' %
+                                       index['index_name'])
+
+            target_model, target_name = index['target']
+            field_to_index = model_from_label(target_model)._meta.get_field(
+                target_name)
+            if class_path(lookup.get_field_to_add(field_to_index).__class__) \
+                    != index['index_field']:
+                raise ManifestMismatch('Index field of %s changed.' %
+                                       index['index_name'])
+            installs.append((backend, lookup, field_to_index))
+
+    columns = []
+    for backend, data in zip(backends, manifest['backends']):
+        column_to_name = {}
+        for column, name in data['column_to_name'].items():
+            column_to_name[str(column)] = load_field_name(name)
+        columns.append((backend, column_to_name))
+    return registrations, installs, columns
+
+def load_manifest(path):
+    '''
+    Rebuilds the index state of all backends from the manifest at path.
+    Returns False without changing any backend if the manifest is missing
+    or doesn't match the current models, backends or registrations.
+    '''
+
+    try:
+        manifest_file = open(path)
+        try:
+            manifest = json.load(manifest_file)
+        finally:
+            manifest_file.close()
+        registrations, installs, columns = read_manifest(manifest)
+    except (IOError, ValueError, KeyError, TypeError, AttributeError,
+            ImportError, FieldDoesNotExist, ManifestMismatch):
+        return False
+
+    resolver.begin_batch()
+    try:
+        for backend, lookup, field_to_index in installs:
+            backend.install_index(lookup, field_to_index)
+        for backend, column_to_name in columns:
+            backend.update_registry(column_to_name=column_to_name)
+    finally:
+        resolver.end_batch()
+    resolver.registrations.extend(registrations)
+    return True
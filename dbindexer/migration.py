@@ -0,0 +1,175 @@
+'''
+Online migrations of versioned indexes, see register_index(version=...).
+A new version of an index gets index fields of its own and moves through
+these states:
+
+backfill: both versions get written, queries read the old one while
+          dbindexer_migrate fills in the new one for the existing rows
+read:     queries read the new version, the old one still gets written so
+          reads can be switched back by resetting the state
+done:     the old version isn't written anymore, its registration can be
+          removed
+
+The states are stored by IndexMigration and polled by every process each
+DBINDEXER_MIGRATION_POLL seconds.
+
+Rows saved during a backfill pass can get overwritten with values computed
+from their previous version, so passes get repeated until one of them finds
+all rows up to date.
+'''
+
+from django.conf import settings
+from datetime import datetime
+import threading
+import time
+
+BACKFILL = 'backfill'
+READ = 'read'
+DONE = 'done'
+READABLE = (READ, DONE)
+
+_lock = threading.RLock()
+_local = threading.local()
+# states by key, replaced as a whole, and the time they got loaded
+_states = None
+_loaded = 0
+
+def load_states():
+    from .models import IndexMigration
+    return dict(IndexMigration.objects.values_list('key', 'state'))
+
+def is_stale():
+    return _states is None or time.time() - _loaded > getattr(settings,
+        'DBINDEXER_MIGRATION_POLL', 60)
+
+def get_state(key):
+    '''
+    Returns the migration state of the index version identified by key.
+    If the states can't be reloaded the previous ones are kept, there is no
+    safe default because the old version of a done migration isn't written
+    anymore.
+    '''
+    global _states, _loaded
+    # loading the states runs queries itself
+    if is_stale() and not getattr(_local, 'loading', False):
+        _lock.acquire()
+        try:
+            if is_stale():
+                _local.loading = True
+                try:
+                    states = load_states()
+                except Exception:
+                    if _states is None:
+                        raise
+                else:
+                    _states = states
+                    _loaded = time.time()
+                finally:
+                    _local.loading = False
+        finally:
+            _lock.release()
+    return (_states or {}).get(key, BACKFILL)
+
+def invalidate():
+    '''Makes the next get_state() call reload the states.'''
+    global _loaded
+    _loaded = 0
+
+def is_readable(key, newer_keys):
+    '''Returns True if queries may use the index version identified by key,
+    which is None for unversioned indexes.'''
+    if key is not None and get_state(key) not in READABLE:
+        return False
+    for newer_key in newer_keys:
+        if get_state(newer_key) in READABLE:
+            return False
+    return True
+
+def is_writable(newer_keys):
+    '''Returns True if an index version whose newer versions are identified
+    by newer_keys still has to be written.'''
+    for newer_key in newer_keys:
+        if get_state(newer_key) == DONE:
+            return False
+    return True
+
+def get_migrations():
+    '''Returns (backend, lookup, key) for all versioned indexes.'''
+    from .manifest import get_backends
+    migrations = []
+    for backend in get_backends():
+        for lookup in backend.registry.versioned:
+            migrations.append((backend, lookup, backend.migration_key(lookup)))
+    return migrations
+
+def backfill(backend, lookup, batch_size=None, sleep=0, report=None,
+             max_passes=5):
+    '''
+    Fills in the index field of lookup for the existing rows in batches of
+    batch_size rows in pk order, sleeping sleep seconds between batches.
+    The progress is saved after each batch, so an interrupted backfill
+    resumes where it stopped. Switches reads to the index once a pass
+    didn't have to write any row, stays in the backfill state if that takes
+    more than max_passes passes. report gets called with the IndexMigration
+    after each batch.
+    '''
+    from .models import IndexMigration
+
+    key = backend.migration_key(lookup)
+    migration, _ = IndexMigration.objects.get_or_create(key=key)
+    if migration.state != BACKFILL:
+        return migration
+
+    while migration.passes < max_passes:
+        backfill_pass(backend, lookup, migration, batch_size, sleep, report)
+        written = migration.written
+        migration.passes += 1
+        migration.last_pk = None
+        migration.written = 0
+        if not written:
+            migration.state = READ
+            migration.finished = datetime.now()
+            migration.save()
+            invalidate()
+            break
+        migration.save()
+    return migration
+
+def backfill_pass(backend, lookup, migration, batch_size, sleep, report):
+    from .backends import get_chunk_size
+
+    model = backend.get_backfill_model(lookup)
+    pk = model._meta.pk
+    rows = model._base_manager.order_by('pk')
+    if migration.last_pk is None:
+        migration.total = rows.count()
+        migration.rows = 0
+        migration.save()
+    else:
+        rows = rows.filter(pk__gt=pk.to_python(migration.last_pk))
+
+    batch_size = batch_size or get_chunk_size()
+    while True:
+        objs = list(rows[:batch_size])
+        if not objs:
+            break
+        migration.written += backend.backfill(lookup, objs)
+        last_pk = objs[-1].pk
+        rows = model._base_manager.order_by('pk').filter(pk__gt=last_pk)
+        migration.last_pk = unicode(last_pk)
+        migration.rows += len(objs)
+        migration.save()
+        if report is not None:
+            report(migration)
+        if len(objs) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+
+def finish(key):
+    '''Stops writing the versions older than the one identified by key.'''
+    from .models import IndexMigration
+    updated = IndexMigration.objects.filter(key=key, state=READ).update(
+        state=DONE)
+    invalidate()
+    return bool(updated)
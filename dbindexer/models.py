@@ -0,0 +1,35 @@
+from django.db import models
+
+class IndexMigration(models.Model):
+    '''State of the migration of a versioned index, see dbindexer.migration.'''
+    key = models.CharField(max_length=255, unique=True)
+    state = models.CharField(max_length=16, default='backfill')
+    # pk of the last backfilled row of the current pass
+    last_pk = models.CharField(max_length=255, null=True)
+    rows = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    # completed passes and rows written by the current one
+    passes = models.IntegerField(default=0)
+    written = models.IntegerField(default=0)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True)
+
+    def progress(self):
+        '''Returns the backfilled fraction of the rows.'''
+        if self.state != 'backfill':
+            return 1.0
+        return self.total and min(1.0, float(self.rows) / self.total) or 0.0
+
+    def throughput(self):
+        '''Returns the backfilled rows per second over all passes.'''
+        seconds = ((self.finished or self.updated) - self.started).total_seconds()
+        rows = self.rows
+        if self.state == 'backfill':
+            rows += self.passes * self.total
+        else:
+            rows += (self.passes - 1) * self.total
+        return seconds > 0 and rows / seconds or 0.0
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.key, self.state)
@@ -1,17 +1,53 @@
 from django.conf import settings
+from django.db.models.signals import pre_init
 from django.utils.importlib import import_module
 from django.core.exceptions import ImproperlyConfigured
+import threading
 
 class Resolver(object):
     def __init__(self):
-        self.backends = []
+        self.backends = ()
+        # register_index calls recorded by lazy registration
+        self.deferred = []
+        # (model, field_name, key) of every registered lookup
+        self.registrations = []
+        self._materialize_lock = threading.RLock()
+        self._materializing = False
         self.load_backends(getattr(settings, 'DBINDEXER_BACKENDS',
-                               ('dbindexer.backends.BaseResolver',
+                               ('dbindexer.backends.ConjunctionResolver',
+                                'dbindexer.backends.BaseResolver',
                                 'dbindexer.backends.FKNullFix')))
 
+    def _get_backends(self):
+        return self._backends
+
+    def _set_backends(self, backends):
+        # backends are replaced as a whole so queries running in other threads
+        # keep iterating over the tuple they started with
+        self._backends = tuple(backends)
+
+    backends = property(_get_backends, _set_backends)
+
     def load_backends(self, backend_paths):
-        for backend in backend_paths:
-                self.backends.append(self.load_backend(backend))
+        self.backends = self.backends + tuple([self.load_backend(backend)
+                                               for backend in backend_paths])
+
+    def get_all_backends(self):
+        '''Returns the backends including the backends they consist of.'''
+        backends = []
+        for backend in self.backends:
+            backends.extend(getattr(backend, 'backends', (backend, )))
+        return backends
+
+    def begin_batch(self):
+        '''Makes the backends publish the indexes created until end_batch()
+        in a single registry each, see BaseResolver.begin_batch().'''
+        for backend in self.get_all_backends():
+            backend.begin_batch()
+
+    def end_batch(self):
+        for backend in reversed(self.get_all_backends()):
+            backend.end_batch()
 
     def load_backend(self, path):
         module_name, attr_name = path.rsplit('.', 1)
@@ -26,16 +62,106 @@ class Resolver(object):
             raise ImproperlyConfigured('Module "%s" does not define a "%s" backend'
                 % (module_name, attr_name))
 
+    def defer_index(self, model, mapping, condition=None, version=None):
+        self._materialize_lock.acquire()
+        try:
+            if not self.deferred:
+                # index fields have to exist before the first instance of any
+                # model gets created
+                pre_init.connect(self._pre_init,
+                                 dispatch_uid='dbindexer.materialize')
+            self.deferred.append((model, mapping, condition, version))
+        finally:
+            self._materialize_lock.release()
+
+    def materialize(self, use_manifest=True):
+        '''
+        Creates the indexes of all deferred register_index calls in a single
+        batch, so each backend publishes its registry once. If the
+        DBINDEXER_MANIFEST setting points to a manifest matching these calls
+        the indexes are rebuilt from it instead.
+        '''
+
+        if not self.deferred:
+            return
+        from .api import register_index
+        path = getattr(settings, 'DBINDEXER_MANIFEST', None)
+
+        self._materialize_lock.acquire()
+        try:
+            if self._materializing:
+                return
+            self._materializing = True
+            try:
+                if use_manifest and path and self.deferred:
+                    from .manifest import load_manifest
+                    if load_manifest(path):
+                        del self.deferred[:]
+                # entries stay visible until they are created so other threads
+                # wait for the lock instead of using incomplete indexes
+                created = 0
+                self.begin_batch()
+                try:
+                    for model, mapping, condition, version in self.deferred:
+                        register_index(model, mapping, lazy=False,
+                                       condition=condition, version=version)
+                        created += 1
+                finally:
+                    self.end_batch()
+                    del self.deferred[:created]
+                pre_init.disconnect(dispatch_uid='dbindexer.materialize')
+            finally:
+                self._materializing = False
+        finally:
+            self._materialize_lock.release()
+
+    def _pre_init(self, sender, **kwargs):
+        self.materialize()
+
     def convert_filters(self, query):
+        if self.deferred:
+            self.materialize()
         for backend in self.backends:
             backend.convert_filters(query)
 
     def create_index(self, lookup):
+        model, field_name = lookup.model, lookup.field_name
+        handled = False
         for backend in self.backends:
-            backend.create_index(lookup)
+            if backend.create_index(lookup):
+                handled = True
+        # otherwise filters on the index would silently reach the database
+        if not handled:
+            raise ImproperlyConfigured('None of DBINDEXER_BACKENDS can index '
+                '%s.%s with %s.' % (model._meta.object_name, field_name,
+                                    lookup.__class__.__name__))
 
     def convert_insert_query(self, query):
+        if self.deferred:
+            self.materialize()
         for backend in self.backends:
             backend.convert_insert_query(query)
 
+    def convert_update_query(self, query):
+        '''Returns the (backend, lookup) pairs whose index values have to be
+        recomputed for each updated object.'''
+        if self.deferred:
+            self.materialize()
+        stale = []
+        for backend in self.backends:
+            stale.extend(backend.convert_update_query(query))
+        return stale
+
+    def get_dependents(self, query):
+        '''Returns the (backend, lookup) pairs whose index values on other
+        models depend on the rows changed by an update or delete query.'''
+        dependents = []
+        for backend in self.backends:
+            dependents.extend(backend.get_dependents(query))
+        return dependents
+
+    def notify_write(self, query, operation):
+        for backend in self.backends:
+            backend.notify_write(query, operation)
+
 resolver = Resolver()
@@ -1,11 +1,19 @@
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, models
+from django.db.models import F, Q
 from django.test import TestCase
-from .api import register_index
-from .lookups import StandardLookup
+from .api import explain, nearby, prefetch, register_index
+from .lookups import Aggregate, GeoHash, Iexact, Istartswith, Search, \
+    StandardLookup, encode_key_part, geohash
+from .manifest import load_manifest, write_manifest
 from .resolver import resolver
+from . import migration
 from djangotoolbox.fields import ListField
 from datetime import datetime
+import json
+import os
 import re
+import tempfile
 
 class ForeignIndexed2(models.Model):
     name_fi2 = models.CharField(max_length=500)
@@ -23,6 +31,12 @@ class Indexed(models.Model):
     foreignkey2 = models.ForeignKey(ForeignIndexed2, related_name='idx_set', null=True)
     tags = ListField(models.CharField(max_length=500, null=True))
 
+class SnapshotIndexed(models.Model):
+    name = models.CharField(max_length=500)
+
+class SharedIndexed(models.Model):
+    name = models.CharField(max_length=500)
+
 class NullableCharField(models.Model):
     name = models.CharField(max_length=500, null=True)
 
@@ -156,6 +170,27 @@ class IndexedTest(TestCase):
         self.assertEqual(1, len(ForeignIndexed.objects.all().filter(
             fk__name_fi2__endswith='bi')))
 
+    def test_join_update(self):
+        # updating JOINed rows refreshes the rows JOINing them on all levels
+        ForeignIndexed2.objects.filter(name_fi2='Juubi').update(
+            name_fi2='Gedo')
+        self.assertEqual(2, len(Indexed.objects.filter(
+            foreignkey__fk__name_fi2__iexact='gEDO')))
+        self.assertEqual(3, len(Indexed.objects.filter(
+            foreignkey2__name_fi2__iexact='gedo')))
+        self.assertEqual(0, len(Indexed.objects.filter(
+            foreignkey__fk__name_fi2__iexact='juubi')))
+        self.assertEqual(1, ForeignIndexed.objects.filter(
+            fk__name_fi2__iexact='GEDO').count())
+
+        # so does moving them to other rows
+        ForeignIndexed.objects.filter(name_fi='Hachibi').update(
+            fk=ForeignIndexed2.objects.get(name_fi2='Gedo'))
+        self.assertEqual(4, len(Indexed.objects.filter(
+            foreignkey__fk__name_fi2__iexact='gedo')))
+        self.assertEqual(0, len(Indexed.objects.filter(
+            foreignkey__fk__name_fi2__iexact='rikudo')))
+
     def test_fix_fk_isnull(self):
         self.assertEqual(0, len(Indexed.objects.filter(foreignkey=None)))
         self.assertEqual(4, len(Indexed.objects.exclude(foreignkey=None)))
@@ -170,6 +205,12 @@ class IndexedTest(TestCase):
         # test on list field
         self.assertEqual(1, Indexed.objects.filter(tags__iexact='SasuKE').count())
 
+    def test_dates_and_aggregates(self):
+        self.assertEqual(1, len(Indexed.objects.filter(
+            name__iexact='itaChi').dates('published', 'year')))
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title__iexact='bijuu')[:2].count())
+
     def test_standard_lookups(self):
         self.assertEqual(1, Indexed.objects.filter(tags__exact='Naruto').count())
 
@@ -177,6 +218,31 @@ class IndexedTest(TestCase):
         juubi = ForeignIndexed2.objects.all().get(name_fi2='Juubi', age=2)
         self.assertEqual(2, Indexed.objects.filter(foreignkey__fk=juubi).count())
 
+    def test_update(self):
+        Indexed.objects.filter(name__iexact='itachi').update(name='Sasuke')
+        self.assertEqual(1, Indexed.objects.filter(
+            name__iexact='SASUKE').count())
+        self.assertEqual(0, Indexed.objects.filter(
+            name__iexact='itachi').count())
+
+        # index values of JOINed fields are computed from the new ForeignKey
+        hachibi = ForeignIndexed.objects.get(name_fi='Hachibi')
+        Indexed.objects.filter(name__iexact='sasuke').update(
+            foreignkey=hachibi)
+        self.assertEqual(3, Indexed.objects.filter(
+            foreignkey__name_fi__iexact='hachibi').count())
+
+        # F() expressions get recomputed for each object
+        ForeignIndexed.objects.filter(name_fi__iexact='kyuubi').update(
+            name_fi=F('title'))
+        self.assertEqual(2, ForeignIndexed.objects.filter(
+            name_fi__iexact='BIJUU').count())
+        # updates matching no objects have no index values to recompute
+        ForeignIndexed.objects.filter(name_fi__iexact='shukaku').update(
+            name_fi=F('title'))
+        self.assertEqual(2, ForeignIndexed.objects.filter(
+            name_fi__iexact='BIJUU').count())
+
     def test_delete(self):
         Indexed.objects.get(name__iexact='itaChi').delete()
         self.assertEqual(0, Indexed.objects.all().filter(name__iexact='itaChi').count())
@@ -191,6 +257,22 @@ class IndexedTest(TestCase):
     def test_istartswith(self):
         self.assertEqual(1, len(Indexed.objects.all().filter(name__istartswith='iTa')))
 
+    def test_shared_encoding(self):
+        # existing index fields keep their names by default
+        field_names = [field.name for field in Indexed._meta.fields]
+        self.assertTrue('idxf_name_l_iexact' in field_names)
+        self.assertTrue('idxf_name_l_istartswith' in field_names)
+
+        # istartswith uses the index field of iexact
+        with self.settings(DBINDEXER_SHARE_ENCODINGS=True):
+            register_index(SharedIndexed, {'name': ('iexact', 'istartswith')})
+            SharedIndexed(name='ItAchi').save()
+            field_names = [field.name for field in SharedIndexed._meta.fields]
+            self.assertTrue('idxf_name_l_iexact' in field_names)
+            self.assertFalse('idxf_name_l_istartswith' in field_names)
+            self.assertEqual(1, len(SharedIndexed.objects.filter(
+                name__istartswith='iTa', name__iexact='itachi')))
+
     def test_endswith(self):
         self.assertEqual(1, len(Indexed.objects.all().filter(name__endswith='imE')))
         self.assertEqual(1, len(Indexed.objects.all().filter(name__iendswith='iMe')))
@@ -204,6 +286,86 @@ class IndexedTest(TestCase):
         """Test indexing with nullable CharFields, see: https://github.com/django-nonrel/django-dbindexer/issues/3."""
         NullableCharField.objects.create()
 
+    def test_ordering(self):
+        self.assertEqual(['I1038593i', 'ItAchi', 'Neji', 'YondAimE'],
+            [item.name for item in Indexed.objects.order_by('name__iexact')])
+        self.assertEqual(['YondAimE', 'Neji'],
+            [item.name for item in Indexed.objects.order_by(
+                '-name__iexact')[:2]])
+
+        # ordering by JOINed fields
+        self.assertEqual('I1038593i', Indexed.objects.order_by(
+            '-foreignkey2__age')[0].name)
+        self.assertEqual(['ItAchi', 'YondAimE'], [item.name for item in
+            Indexed.objects.filter(foreignkey2__name_fi2__iexact='juubi'
+                ).order_by('foreignkey__fk__name_fi2__iexact',
+                           'name__iexact')[:2]])
+
+    def test_explain(self):
+        queryset = Indexed.objects.filter(name__iexact='itaChi')
+        explanation = explain(queryset, live=True)
+        self.assertEqual(['idxf_name_l_iexact'], [rewrite['index_name']
+            for rewrite in explanation.rewrites])
+        self.assertEqual(1, explanation.rows)
+        # explaining doesn't change the queryset
+        self.assertEqual(1, queryset.count())
+
+    def test_compact_lookups(self):
+        lookup = Iexact()
+        self.assertFalse(hasattr(lookup, '__dict__'))
+        # every index gets its own field built from the shared prototype
+        field = Indexed._meta.get_field('name')
+        self.assertFalse(lookup.get_field_to_add(field) is
+                         lookup.get_field_to_add(field))
+
+    def test_registry_snapshot(self):
+        backend = resolver.backends[0]
+        registry = backend.registry
+        lookups = registry.lookups
+        register_index(SnapshotIndexed, {'name': 'icontains'})
+
+        # registration publishes a new registry instead of changing the old one
+        self.assertTrue(registry.lookups is lookups)
+        self.assertFalse(backend.registry is registry)
+        self.assertEqual(len(lookups) + 1, len(backend.registry.lookups))
+
+        # the registry can't be changed through the backend's properties
+        backend.index_map.clear()
+        backend.column_to_name.clear()
+        self.assertEqual(len(lookups) + 1, len(backend.registry.index_map))
+        self.assertTrue(backend.registry.column_to_name)
+
+    def test_registry_batch(self):
+        backend = resolver.backends[0]
+        registry = backend.registry
+        resolver.begin_batch()
+        try:
+            register_index(SnapshotIndexed, {'name': 'iexact'})
+            register_index(SnapshotIndexed, {'name': 'istartswith'})
+            # additions get published once the batch ends
+            self.assertTrue(backend.registry is registry)
+        finally:
+            resolver.end_batch()
+        self.assertEqual(len(registry.lookups) + 2,
+                         len(backend.registry.lookups))
+
+    def test_manifest(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            write_manifest(path)
+            manifest = json.load(open(path))
+            index_names = [index['index_name']
+                           for data in manifest['backends']
+                           for index in data['indexes']]
+            self.assertTrue('idxf_name_l_iexact' in index_names)
+            self.assertTrue('idxf_foreignkey__title_l_iexact' in index_names)
+
+            # the manifest doesn't match the (missing) deferred registrations
+            self.assertFalse(load_manifest(path))
+        finally:
+            os.remove(path)
+
     def test_contains(self):
         self.assertEqual(1, len(Indexed.objects.all().filter(name__contains='Aim')))
         self.assertEqual(1, len(Indexed.objects.all().filter(name__icontains='aim')))
@@ -214,6 +376,549 @@ class IndexedTest(TestCase):
         self.assertEqual(2, len(Indexed.objects.all().filter(tags__icontains='RA')))
 
 
+class InMemoryJOINTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+                      'dbindexer.backends.InMemoryJOINResolver',
+        ))
+        register_index(Indexed, {
+            'foreignkey__title': 'iexact',
+            'foreignkey__name_fi': 'iexact',
+            'foreignkey2__name_fi2': 'iexact',
+            'foreignkey__fk__name_fi2': 'iexact',
+        })
+
+        juubi = ForeignIndexed2(name_fi2='Juubi', age=2)
+        juubi.save()
+        rikudo = ForeignIndexed2(name_fi2='Rikudo', age=200)
+        rikudo.save()
+
+        kyuubi = ForeignIndexed(name_fi='Kyuubi', title='Bijuu', fk=juubi)
+        hachibi= ForeignIndexed(name_fi='Hachibi', title='Bijuu', fk=rikudo)
+        kyuubi.save()
+        hachibi.save()
+
+        Indexed(name='ItAchi', foreignkey=kyuubi, foreignkey2=juubi).save()
+        Indexed(name='YondAimE', foreignkey=kyuubi, foreignkey2=juubi).save()
+        Indexed(name='Neji', foreignkey=hachibi, foreignkey2=juubi).save()
+        Indexed(name='I1038593i', foreignkey=hachibi,
+                foreignkey2=rikudo).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_joins(self):
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title__iexact='biJuu',
+            foreignkey__name_fi__iexact='kyuuBi').count())
+        self.assertEqual(1, Indexed.objects.filter(
+            foreignkey__name_fi__iexact='hachiBi',
+            foreignkey2__name_fi2__iexact='rikuDo').count())
+
+        # independent JOINs via the same foreign key get intersected
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__fk__name_fi2__iexact='juuBi',
+            foreignkey__title__iexact='biJuu').count())
+        self.assertEqual(0, Indexed.objects.filter(
+            foreignkey__fk__name_fi2__iexact='juuBi',
+            foreignkey2__name_fi2__iexact='rikuDo').count())
+
+    def test_threads(self):
+        querysets = [
+            Indexed.objects.filter(foreignkey__name_fi__iexact='hachiBi',
+                                   foreignkey2__name_fi2__iexact='rikuDo'),
+            Indexed.objects.filter(foreignkey__fk__name_fi2__iexact='juuBi',
+                                   foreignkey__title__iexact='biJuu'),
+            Indexed.objects.filter(Q(foreignkey__name_fi__iexact='kyuuBi') |
+                                   Q(foreignkey2__name_fi2__iexact='rikuDo')),
+        ]
+        def pks():
+            return [sorted([obj.pk for obj in queryset.all()])
+                    for queryset in querysets]
+
+        serial = pks()
+        # independent JOINs get resolved by the thread pool
+        with self.settings(DBINDEXER_JOIN_THREADS=2):
+            self.assertEqual(serial, pks())
+        self.assertEqual([1, 2, 3], [len(item) for item in serial])
+
+    def test_delete(self):
+        from .compiler import SQLDeleteCompiler
+        batches = []
+        delete_batches = SQLDeleteCompiler.delete_batches
+        def count_batches(compiler):
+            for batch in delete_batches(compiler):
+                batches.append(batch)
+                yield batch
+
+        SQLDeleteCompiler.delete_batches = count_batches
+        try:
+            with self.settings(DBINDEXER_CHUNK_SIZE=1):
+                Indexed.objects.filter(
+                    foreignkey__title__iexact='biJuu').delete()
+        finally:
+            SQLDeleteCompiler.delete_batches = delete_batches
+        self.assertEqual(0, Indexed.objects.count())
+        # the resolved pks got deleted in several batches
+        self.assertTrue(len(batches) > 1)
+
+    def test_explain(self):
+        explanation = explain(Indexed.objects.filter(
+            foreignkey__name_fi__iexact='kyuuBi'))
+        self.assertEqual([1], [join_query['pks'] for join_query in
+                               explanation.join_queries])
+        self.assertEqual('in', explanation.rewrites[-1]['lookup_type'])
+        self.assertEqual(None, explanation.rows)
+
+    def test_pk_cache(self):
+        from .backends import PKCache
+        backend = resolver.backends[2]
+        backend.pk_cache = PKCache(10)
+
+        for i in range(2):
+            self.assertEqual(2, Indexed.objects.filter(
+                foreignkey__name_fi__iexact='kyuuBi').count())
+        self.assertEqual(1, backend.pk_cache.stats()['hits'])
+
+        # writes to ForeignIndexed invalidate its cached pks
+        ForeignIndexed(name_fi='Kyuubi', title='Bijuu').save()
+        self.assertEqual(0, backend.pk_cache.stats()['size'])
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__name_fi__iexact='kyuuBi').count())
+        self.assertEqual(1, backend.pk_cache.stats()['hits'])
+
+        # pks queried before a write don't get cached after it
+        key = backend.pk_cache.key(ForeignIndexed, {'name_fi': 'Kyuubi'})
+        generation = backend.pk_cache.generation(key)
+        ForeignIndexed(name_fi='Kyuubi', title='Bijuu').save()
+        backend.pk_cache.set(key, frozenset([1]), generation)
+        self.assertEqual(None, backend.pk_cache.get(key))
+
+    def test_or(self):
+        queryset = Indexed.objects.filter(
+            Q(foreignkey__name_fi__iexact='kyuuBi') |
+            Q(foreignkey2__name_fi2__iexact='rikuDo'))
+        self.assertEqual(3, queryset.count())
+
+        # JOINs via different foreign keys become one filter on the pks
+        filters = explain(queryset).filters
+        self.assertEqual(1, len(filters))
+        self.assertTrue(filters[0].startswith('Indexed.id__in='))
+
+        # both children JOIN via foreignkey so they get merged
+        self.assertEqual(4, Indexed.objects.filter(
+            Q(foreignkey__name_fi__iexact='kyuuBi') |
+            Q(foreignkey__name_fi__iexact='hachiBi')).count())
+
+class CostBasedJOINTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+                      'dbindexer.backends.CostBasedJOINResolver',
+        ))
+        register_index(Indexed, {'foreignkey__title': 'iexact'})
+
+        self.kyuubi = ForeignIndexed(name_fi='Kyuubi', title='Bijuu')
+        self.kyuubi.save()
+        Indexed(name='ItAchi', foreignkey=self.kyuubi).save()
+        Indexed(name='YondAimE', foreignkey=self.kyuubi).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_choose_strategy(self):
+        planner = resolver.backends[2]
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title__iexact='biJuu').count())
+        self.assertEqual('denormalized', planner.decisions[-1]['strategy'])
+        self.assertEqual(1, planner.decisions[-1]['denormalized_cost'])
+
+        # updates of the JOINed model refresh the denormalized index
+        ForeignIndexed.objects.filter(pk=self.kyuubi.pk).update(title='Kurama')
+        self.assertEqual(0, Indexed.objects.filter(
+            foreignkey__title__iexact='biJuu').count())
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title__iexact='kuRAMA').count())
+        self.assertEqual('denormalized', planner.decisions[-1]['strategy'])
+
+        # filters without a denormalized index get JOINed in memory
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title='Kurama').count())
+        self.assertEqual('in_memory', planner.decisions[-1]['strategy'])
+        self.assertEqual(None, planner.decisions[-1]['denormalized_cost'])
+        self.assertEqual(2, planner.statistics[
+            (Indexed, 'foreignkey__title', 'exact')])
+
+    def test_cached_join(self):
+        from .backends import PKCache
+        register_index(Indexed, {'foreignkey__title': StandardLookup()})
+        for indexed in Indexed.objects.all():
+            indexed.save()
+        planner = resolver.backends[2]
+        titles = ['Title%d' % number for number in range(89)] + ['Bijuu']
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title__in=titles).count())
+        self.assertEqual('denormalized', planner.decisions[-1]['strategy'])
+        self.assertEqual(3, planner.decisions[-1]['denormalized_cost'])
+
+        # small JOINs answered by the pk cache beat filtering by 90 values
+        planner.in_memory.pk_cache = PKCache(10)
+        planner.in_memory.pk_cache.hits = 100
+        planner.statistics[(Indexed, 'foreignkey__title', 'in')] = 2
+        self.assertEqual(2, Indexed.objects.filter(
+            foreignkey__title__in=titles).count())
+        self.assertEqual('in_memory', planner.decisions[-1]['strategy'])
+
+class InequalityIndexed(models.Model):
+    a = models.IntegerField()
+    b = models.IntegerField()
+
+class InequalityTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+                      'dbindexer.backends.InequalityResolver',
+        ))
+        for i in range(10):
+            InequalityIndexed(a=i, b=9 - i).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_multiple_inequalities(self):
+        self.assertEqual(6, len(InequalityIndexed.objects.filter(
+            a__gte=2, b__gte=2)))
+        self.assertEqual([3, 4], [item.a for item in
+            InequalityIndexed.objects.filter(a__gte=2, b__range=(2, 7)
+                                             ).order_by('a')[1:3]])
+        self.assertEqual(6, InequalityIndexed.objects.filter(
+            a__gte=2, b__gte=2).count())
+
+    def test_reused_queryset(self):
+        queryset = InequalityIndexed.objects.filter(a__gte=2, b__gte=2)
+        self.assertEqual(6, len(queryset))
+        # querysets derived from an evaluated one keep its residual filters
+        self.assertEqual(6, len(queryset.order_by('-a')))
+        self.assertEqual(6, len(queryset[:10]))
+        self.assertEqual(4, queryset.filter(a__lte=5).count())
+
+class CompositeIndexed(models.Model):
+    tenant = models.CharField(max_length=100)
+    name = models.CharField(max_length=100)
+    published = models.DateTimeField()
+    text = models.CharField(max_length=500)
+
+class CompositeTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.ConjunctionResolver',
+                      'dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(CompositeIndexed, {
+            ('tenant', 'name__iexact', 'published__year'): 'composite',
+        })
+        for tenant, name, year in (('konoha', 'Naruto', 2002),
+                                   ('konoha', 'Naruto', 2007),
+                                   ('konoha', 'Sasuke', 2002),
+                                   ('suna', 'Gaara', 2002)):
+            CompositeIndexed(tenant=tenant, name=name,
+                             published=datetime(year, 1, 1)).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_composite(self):
+        self.assertEqual(1, CompositeIndexed.objects.filter(tenant='konoha',
+            name__iexact='NARUTO', published__year=2002).count())
+        # filters on leading fields use a prefix of the key
+        self.assertEqual(2, CompositeIndexed.objects.filter(tenant='konoha',
+            name__iexact='naruto').count())
+        self.assertEqual(0, CompositeIndexed.objects.filter(tenant='suna',
+            name__iexact='naruto').count())
+
+    def test_key_length(self):
+        # hex-encoded keys are twice as long as the values of their fields
+        self.assertRaises(ImproperlyConfigured, register_index,
+                          CompositeIndexed, {('tenant', 'text'): 'composite'})
+
+    def test_missing_backend(self):
+        # without ConjunctionResolver the filters would reach the database
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        self.assertRaises(ImproperlyConfigured, register_index,
+                          CompositeIndexed, {('tenant', 'name'): 'composite'})
+
+    def test_key_order(self):
+        keys = [encode_key_part(-2.5), encode_key_part(-1.0),
+                encode_key_part(0.0), encode_key_part(3.25)]
+        self.assertEqual(sorted(keys), keys)
+        keys = [encode_key_part(u'a') + encode_key_part(2),
+                encode_key_part(u'a') + encode_key_part(10),
+                encode_key_part(u'ab') + encode_key_part(-1)]
+        self.assertEqual(sorted(keys), keys)
+
+class SearchIndexed(models.Model):
+    text = models.CharField(max_length=500)
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(SearchIndexed, {'text': 'search'})
+        SearchIndexed(text=u'The quick brown fox').save()
+        SearchIndexed(text=u'A quick Caf\xe9 visit').save()
+        SearchIndexed(text=u'Lazy dogs').save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_search(self):
+        self.assertEqual([u'lazy', u'dogs'], SearchIndexed.objects.get(
+            text=u'Lazy dogs').idxf_text_l_search)
+        self.assertEqual(2, SearchIndexed.objects.filter(
+            text__search='QUICK').count())
+        # all words have to match
+        self.assertEqual(1, SearchIndexed.objects.filter(
+            text__search='fox, quick').count())
+        self.assertEqual(0, SearchIndexed.objects.filter(
+            text__search='quick dogs').count())
+        # accents get stripped
+        self.assertEqual(1, SearchIndexed.objects.filter(
+            text__search='cafe').count())
+        self.assertEqual(0, SearchIndexed.objects.filter(
+            text__search='...').count())
+        # searches without words match nothing instead of everything
+        self.assertEqual(['SearchIndexed.idxf_text_l_search__in=[]'],
+            explain(SearchIndexed.objects.filter(text__search='...')).filters)
+
+class GeoIndexed(models.Model):
+    name = models.CharField(max_length=500)
+    lat = models.FloatField()
+    lng = models.FloatField()
+
+class GeoHashTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.ConjunctionResolver',
+                      'dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(GeoIndexed, {('lat', 'lng'): 'geohash'})
+        for name, lat, lng in (('Berlin', 52.52, 13.405),
+                               ('Potsdam', 52.39, 13.06),
+                               ('Hamburg', 53.55, 9.99),
+                               ('Munich', 48.14, 11.58)):
+            GeoIndexed(name=name, lat=lat, lng=lng).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_geohash(self):
+        self.assertEqual('u4pruydqqvj', geohash(57.64911, 10.40744, 11))
+        self.assertEqual(['u', 'u3', 'u33', 'u33d', 'u33dc', 'u33dc0',
+                          'u33dc0c', 'u33dc0cp'], GeoIndexed.objects.get(
+            name='Berlin').idxf_lat__lng_l_geohash)
+
+    def test_bounding_box(self):
+        self.assertEqual(['Berlin', 'Potsdam'], sorted([obj.name for obj in
+            GeoIndexed.objects.filter(lat__range=(52, 53),
+                                      lng__range=(12.5, 14))]))
+        self.assertEqual(1, GeoIndexed.objects.filter(lat__gte=52.4,
+            lat__lte=53, lng__gte=12.5, lng__lte=14).count())
+
+    def test_nearby(self):
+        self.assertEqual(['Berlin'], [obj.name for obj in
+            nearby(GeoIndexed.objects.all(), ('lat', 'lng'), (52.5, 13.4),
+                   10000)])
+        self.assertEqual(['Berlin', 'Potsdam'], sorted([obj.name for obj in
+            nearby(GeoIndexed.objects.all(), ('lat', 'lng'), (52.5, 13.4),
+                   50000)]))
+
+class BucketIndexed(models.Model):
+    published = models.DateTimeField()
+    size = models.IntegerField()
+
+class BucketTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.ConjunctionResolver',
+                      'dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(BucketIndexed, {'published': 'bucket',
+                                       'size': 'bucket'})
+        for published, size in ((datetime(2013, 1, 1, 10), 3),
+                                (datetime(2013, 1, 1, 23), 17),
+                                (datetime(2013, 1, 2, 1), 300),
+                                (datetime(2013, 2, 1), 40)):
+            BucketIndexed(published=published, size=size).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_buckets(self):
+        self.assertEqual(['2013-01-01T10', '2013-01-01', '2013-01', '2013'],
+            BucketIndexed.objects.get(size=3).idxf_published_l_bucket)
+        self.assertEqual(['0:17', '4:1', '8:0', '12:0', '16:0', '20:0',
+                          '24:0'],
+            BucketIndexed.objects.get(size=17).idxf_size_l_bucket)
+
+    def test_range(self):
+        self.assertEqual(2, BucketIndexed.objects.filter(published__range=(
+            datetime(2013, 1, 1, 12), datetime(2013, 1, 2, 2))).count())
+        self.assertEqual(3, BucketIndexed.objects.filter(
+            published__gt=datetime(2013, 1, 1, 10),
+            published__lte=datetime(2013, 3, 1)).count())
+        self.assertEqual([17, 40], sorted([obj.size for obj in
+            BucketIndexed.objects.filter(size__gt=10, size__lt=300)]))
+
+class AggregateParent(models.Model):
+    name = models.CharField(max_length=500)
+
+class AggregateChild(models.Model):
+    parent = models.ForeignKey(AggregateParent)
+    published = models.DateTimeField()
+
+class AggregateTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.AggregateResolver',
+                      'dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(AggregateParent, {
+            'aggregatechild_set': 'count',
+            'aggregatechild_set__published': 'max',
+        })
+        self.naruto = AggregateParent.objects.create(name='Naruto')
+        self.sasuke = AggregateParent.objects.create(name='Sasuke')
+        for parent, year in ((self.naruto, 2002), (self.naruto, 2007),
+                             (self.sasuke, 2003)):
+            AggregateChild(parent=parent,
+                           published=datetime(year, 1, 1)).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_insert(self):
+        self.assertEqual(['Naruto'], [parent.name for parent in
+            AggregateParent.objects.filter(
+                idxf_aggregatechild_set_l_count__gt=1)])
+        self.assertEqual(datetime(2007, 1, 1), AggregateParent.objects.get(
+            name='Naruto').idxf_aggregatechild_set_published_l_max)
+        self.assertEqual(['Naruto', 'Sasuke'], [parent.name for parent in
+            AggregateParent.objects.order_by(
+                '-idxf_aggregatechild_set_published_l_max')])
+
+    def test_incremental_insert(self):
+        # inserts merge into the stored values instead of recomputing them
+        AggregateParent.objects.filter(name='Naruto').update(
+            idxf_aggregatechild_set_l_count=5)
+        AggregateChild(parent=self.naruto,
+                       published=datetime(2009, 1, 1)).save()
+        AggregateChild(parent=self.naruto,
+                       published=datetime(2001, 1, 1)).save()
+        naruto = AggregateParent.objects.get(name='Naruto')
+        self.assertEqual(7, naruto.idxf_aggregatechild_set_l_count)
+        self.assertEqual(datetime(2009, 1, 1),
+                         naruto.idxf_aggregatechild_set_published_l_max)
+
+        lookup = Aggregate(function='sum')
+        self.assertEqual(3, lookup.merge(None, [1, None, 2]))
+        self.assertEqual(6, lookup.merge(3, [1, 2]))
+        self.assertEqual(2, Aggregate(function='min').merge(2, [None]))
+
+    def test_update_and_delete(self):
+        AggregateChild.objects.filter(
+            published=datetime(2007, 1, 1)).delete()
+        naruto = AggregateParent.objects.get(name='Naruto')
+        self.assertEqual(1, naruto.idxf_aggregatechild_set_l_count)
+        self.assertEqual(datetime(2002, 1, 1),
+                         naruto.idxf_aggregatechild_set_published_l_max)
+
+        # moving rows updates the old and the new parent
+        AggregateChild.objects.filter(parent=self.sasuke).update(
+            parent=self.naruto)
+        sasuke = AggregateParent.objects.get(name='Sasuke')
+        self.assertEqual(0, sasuke.idxf_aggregatechild_set_l_count)
+        self.assertEqual(None, sasuke.idxf_aggregatechild_set_published_l_max)
+        self.assertEqual(2, AggregateParent.objects.get(
+            name='Naruto').idxf_aggregatechild_set_l_count)
+
+class ReverseJOINTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.ReverseJOINResolver',
+                      'dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(ForeignIndexed2, {'idx_set__name': 'iexact'})
+        self.konoha = ForeignIndexed2.objects.create(name_fi2='Konoha', age=3)
+        self.suna = ForeignIndexed2.objects.create(name_fi2='Suna', age=5)
+        for name, village in (('Itachi', self.konoha),
+                              ('Naruto', self.konoha),
+                              ('Gaara', self.suna)):
+            Indexed(name=name, foreignkey2=village, tags=[]).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_reverse_filter(self):
+        self.assertEqual([u'itachi', u'naruto'], ForeignIndexed2.objects.get(
+            name_fi2='Konoha').idxf_idx_set_r_name_l_iexact)
+        self.assertEqual(['Konoha'], [village.name_fi2 for village in
+            ForeignIndexed2.objects.filter(idx_set__name__iexact='ITACHI')])
+        self.assertEqual(0, ForeignIndexed2.objects.filter(
+            idx_set__name__iexact='kakashi').count())
+
+    def test_update_and_delete(self):
+        Indexed.objects.filter(name='Itachi').delete()
+        self.assertEqual(0, ForeignIndexed2.objects.filter(
+            idx_set__name__iexact='itachi').count())
+
+        Indexed.objects.filter(name='Gaara').update(foreignkey2=self.konoha)
+        self.assertEqual(['Konoha'], [village.name_fi2 for village in
+            ForeignIndexed2.objects.filter(idx_set__name__iexact='gaara')])
+        self.assertEqual([], ForeignIndexed2.objects.get(
+            name_fi2='Suna').idxf_idx_set_r_name_l_iexact)
+
+class PrefetchTest(TestCase):
+    def setUp(self):
+        konoha = ForeignIndexed2.objects.create(name_fi2='Konoha', age=3)
+        suna = ForeignIndexed2.objects.create(name_fi2='Suna', age=5)
+        for title, village in (('Hokage', konoha), ('Kazekage', suna),
+                               ('Jonin', konoha), ('Missing-nin', None)):
+            ForeignIndexed(title=title, name_fi=title, fk=village).save()
+
+    def test_prefetch(self):
+        cache_name = ForeignIndexed._meta.get_field('fk').get_cache_name()
+        objs = list(prefetch(ForeignIndexed.objects.all().order_by('title'),
+                             'fk'))
+        self.assertEqual([True, True, True, False],
+                         [hasattr(obj, cache_name) for obj in objs])
+        self.assertEqual(['Konoha', 'Konoha', 'Suna', None],
+            [obj.fk and obj.fk.name_fi2 for obj in objs])
+        self.assertRaises(ValueError, prefetch,
+                          ForeignIndexed.objects.all(), 'title')
+
 class AutoNowIndexed(models.Model):
     published = models.DateTimeField(auto_now=True)
 
@@ -264,3 +969,260 @@ class DateAutoNowTest(TestCase):
         self.assertEqual(4, len(DateIndexed.objects.all().filter(published__year=now.year)))
         self.assertEqual(4, len(DateIndexed.objects.all().filter(
             published__week_day=now.isoweekday())))
+
+class PartialIndexed(models.Model):
+    name = models.CharField(max_length=500)
+    published = models.BooleanField(default=False)
+
+class PartialIndexTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        register_index(PartialIndexed, {'name': 'icontains'},
+                       condition={'published': True})
+        PartialIndexed(name='Kakashi', published=True).save()
+        PartialIndexed(name='Kakuzu').save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_condition(self):
+        backend = resolver.backends[0]
+        index_name = backend.index_name(backend.registry.lookups[0])
+        self.assertTrue(index_name.startswith('idxf_name_l_icontains_c'))
+        self.assertEqual(None, getattr(PartialIndexed.objects.get(
+            name='Kakuzu'), index_name))
+        self.assertEqual(1, PartialIndexed.objects.filter(published=True,
+            name__icontains='KAK').count())
+
+        # publishing indexes the row
+        PartialIndexed.objects.filter(name='Kakuzu').update(published=True)
+        self.assertEqual(2, PartialIndexed.objects.filter(published=True,
+            name__icontains='KAK').count())
+
+    def test_shared_encoding(self):
+        # indexes of different conditions don't share fields
+        with self.settings(DBINDEXER_SHARE_ENCODINGS=True):
+            register_index(PartialIndexed, {'name': 'iexact'})
+            register_index(PartialIndexed, {'name': 'istartswith'},
+                           condition={'published': True})
+            PartialIndexed(name='Kisame').save()
+            backend = resolver.backends[0]
+            self.assertEqual(3, len(set([backend.get_index(lookup) for
+                lookup in backend.registry.lookups])))
+            # rows outside the condition are indexed by iexact
+            self.assertEqual(1, PartialIndexed.objects.filter(
+                name__iexact='kisame').count())
+
+class MigrationIndexed(models.Model):
+    name = models.CharField(max_length=500)
+
+def stem(word):
+    return word.rstrip('s')
+
+class MigrationTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+        migration.invalidate()
+        register_index(MigrationIndexed, {'name': 'iexact'})
+        for name in ('Kakashi', 'Kakuzu', 'Itachi'):
+            MigrationIndexed(name=name).save()
+        register_index(MigrationIndexed, {'name': 'iexact'}, version=2)
+
+    def tearDown(self):
+        resolver.backends = self.backends
+        migration.invalidate()
+
+    def test_migration(self):
+        backend = resolver.backends[0]
+        lookup = backend.registry.versioned[0]
+        key = backend.migration_key(lookup)
+        self.assertEqual('dbindexer.MigrationIndexed:idxf_name_l_iexact_v2',
+                         key)
+
+        # reads use the old index while the new one gets backfilled
+        self.assertEqual(None, MigrationIndexed.objects.get(
+            name='Kakashi').idxf_name_l_iexact_v2)
+        self.assertEqual(1, MigrationIndexed.objects.filter(
+            name__iexact='kakashi').count())
+
+        # new rows get written to both indexes
+        MigrationIndexed(name='Deidara').save()
+        obj = MigrationIndexed.objects.get(name='Deidara')
+        self.assertEqual('deidara', obj.idxf_name_l_iexact)
+        self.assertEqual('deidara', obj.idxf_name_l_iexact_v2)
+
+        reports = []
+        state = migration.backfill(backend, lookup, batch_size=2,
+                                   report=reports.append)
+        self.assertEqual(migration.READ, state.state)
+        self.assertEqual(4, state.rows)
+        # the second pass verifies the first one
+        self.assertEqual(2, state.passes)
+        self.assertEqual(4, len(reports))
+        self.assertEqual(1.0, state.progress())
+        self.assertEqual('kakashi', MigrationIndexed.objects.get(
+            name='Kakashi').idxf_name_l_iexact_v2)
+        self.assertEqual(['idxf_name_l_iexact_v2'],
+            [rewrite['index_name'] for rewrite in explain(
+                MigrationIndexed.objects.filter(
+                    name__iexact='KAKASHI')).rewrites])
+        self.assertEqual(1, MigrationIndexed.objects.filter(
+            name__iexact='KAKASHI').count())
+
+        # finished migrations don't write the old index anymore
+        self.assertTrue(migration.finish(key))
+        MigrationIndexed(name='Sasori').save()
+        obj = MigrationIndexed.objects.get(name='Sasori')
+        self.assertEqual(None, obj.idxf_name_l_iexact)
+        self.assertEqual('sasori', obj.idxf_name_l_iexact_v2)
+
+    def test_concurrent_write(self):
+        backend = resolver.backends[0]
+        lookup = backend.registry.versioned[0]
+
+        # a stale value written after the first batch, e.g. by a backfill
+        # racing a save
+        def report(state):
+            if state.passes == 0 and state.rows == 2:
+                MigrationIndexed.objects.filter(name='Kakashi').update(
+                    idxf_name_l_iexact_v2='stale')
+        state = migration.backfill(backend, lookup, batch_size=2,
+                                   report=report)
+        self.assertEqual(migration.READ, state.state)
+        self.assertEqual(3, state.passes)
+        self.assertEqual('kakashi', MigrationIndexed.objects.get(
+            name='Kakashi').idxf_name_l_iexact_v2)
+
+    def test_other_lookups(self):
+        # versions are told apart by registration, not by index field
+        with self.settings(DBINDEXER_SHARE_ENCODINGS=True):
+            register_index(MigrationIndexed, {'name': 'istartswith'})
+            backend = resolver.backends[0]
+            lookups = [lookup for lookup in backend.registry.lookups
+                       if isinstance(lookup, Istartswith)]
+            self.assertEqual(1, len(lookups))
+            self.assertFalse(lookups[0] in backend.registry.newer)
+
+    def test_changed_arguments(self):
+        # versions can change the encoding of an index
+        register_index(MigrationIndexed, {'name': 'search'})
+        register_index(MigrationIndexed, {'name': Search(stemmer=stem)},
+                       version=2)
+        backend = resolver.backends[0]
+        old, new = sorted([lookup for lookup in backend.registry.lookups
+                           if isinstance(lookup, Search)],
+                          key=lambda lookup: lookup.version)
+        self.assertEqual((new, ), backend.registry.newer[old])
+
+        queryset = MigrationIndexed.objects.filter(name__search='Kakashis')
+        self.assertEqual(['idxf_name_l_search'], [rewrite['index_name']
+            for rewrite in explain(queryset).rewrites])
+        migration.backfill(backend, new)
+        self.assertEqual(['idxf_name_l_search_v2'], [rewrite['index_name']
+            for rewrite in explain(queryset).rewrites])
+        self.assertEqual(1, queryset.count())
+
+    def test_load_failure(self):
+        backend = resolver.backends[0]
+        key = backend.migration_key(backend.registry.versioned[0])
+        migration.backfill(backend, backend.registry.versioned[0])
+        self.assertEqual(migration.READ, migration.get_state(key))
+
+        def load_states():
+            raise DatabaseError()
+        load = migration.load_states
+        migration.load_states = load_states
+        try:
+            # the previous states are kept
+            migration.invalidate()
+            self.assertEqual(migration.READ, migration.get_state(key))
+        finally:
+            migration.load_states = load
+        self.assertEqual(migration.READ, migration.get_state(key))
+
+class LazyIndexed(models.Model):
+    name = models.CharField(max_length=500)
+
+class LazyRegistrationTest(TestCase):
+    def test_materialize(self):
+        register_index(LazyIndexed, {'name': 'iexact'}, lazy=True)
+        self.assertEqual(1, len(resolver.deferred))
+        self.assertRaises(Exception, LazyIndexed._meta.get_field,
+                          'idxf_name_l_iexact')
+
+        # creating an instance materializes all deferred indexes
+        LazyIndexed(name='Kakashi').save()
+        self.assertEqual(0, len(resolver.deferred))
+        LazyIndexed._meta.get_field('idxf_name_l_iexact')
+        self.assertEqual(1, LazyIndexed.objects.filter(
+            name__iexact='kakaSHI').count())
+
+class ManifestIndexed(models.Model):
+    name = models.CharField(max_length=500)
+    lat = models.FloatField()
+    lng = models.FloatField()
+
+class ManifestTest(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        self.registrations = resolver.registrations
+        resolver.registrations = []
+        self.load_backends()
+        register_index(ManifestIndexed, {'name': 'iexact',
+                                         ('lat', 'lng'): GeoHash(precision=6)})
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        write_manifest(self.path)
+        self.load_backends()
+        resolver.registrations = []
+
+    def tearDown(self):
+        os.remove(self.path)
+        resolver.backends = self.backends
+        resolver.registrations = self.registrations
+
+    def load_backends(self):
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.ConjunctionResolver',
+                      'dbindexer.backends.BaseResolver',
+                      'dbindexer.backends.FKNullFix',
+        ))
+
+    def test_other_arguments(self):
+        register_index(ManifestIndexed, {'name': 'iexact',
+            ('lat', 'lng'): GeoHash(precision=7)}, lazy=True)
+        self.assertFalse(load_manifest(self.path))
+        resolver.materialize(use_manifest=False)
+
+    def test_load(self):
+        geohash_lookup = GeoHash(precision=6)
+        register_index(ManifestIndexed, {'name': 'iexact',
+            ('lat', 'lng'): geohash_lookup}, lazy=True)
+        with self.settings(DBINDEXER_MANIFEST=self.path):
+            resolver.materialize()
+        self.assertEqual(0, len(resolver.deferred))
+
+        # the lookups got rebuilt from the manifest with their arguments
+        lookups = resolver.backends[0].registry.lookups
+        self.assertFalse(geohash_lookup in lookups)
+        self.assertEqual([6], [lookup.precision for lookup in lookups])
+        self.assertEqual(['idxf_name_l_iexact'], [lookup.index_name
+            for lookup in resolver.backends[1].registry.lookups])
+
+        ManifestIndexed(name='Kakashi', lat=48.8584, lng=2.2945).save()
+        obj = ManifestIndexed.objects.get(name='Kakashi')
+        self.assertEqual('kakashi', obj.idxf_name_l_iexact)
+        self.assertEqual(geohash(48.8584, 2.2945, 6),
+                         obj.idxf_lat__lng_l_geohash[-1])
+        self.assertEqual(1, ManifestIndexed.objects.filter(
+            name__iexact='KAKASHI').count())
+        self.assertEqual(1, ManifestIndexed.objects.filter(
+            lat__range=(48.8, 48.9), lng__range=(2.2, 2.3)).count())